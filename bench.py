@@ -0,0 +1,321 @@
+import argparse
+import contextlib
+import copy
+import gc
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Callable
+
+import human
+import label_fmt
+import msg_parser as msg
+from bp_record import BPRecords
+from device_sim import Device
+from proto import Exchange, BPWindow
+from tools import pretty_hex
+
+# Times every stage over the real capture corpus (dumps_id/) and over
+# synthetic captures built from simulated syncs, see `--help`.
+
+def parse_args(args):
+    parser = argparse.ArgumentParser("Benchmark the parse stages and the sync state machine")
+    parser.add_argument('-i', '--input', type=str, default='dumps_id',
+                        help="directory with json packet dumps")
+    parser.add_argument('--scale', type=int, default=10,
+                        help="synthetic capture size, in multiples of the corpus (0 = corpus only)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per benchmark, the best one is reported")
+    parser.add_argument('--no-mem', action='store_true',
+                        help="skip the (slower) peak memory run")
+    parser.add_argument('--only', type=str, action='append',
+                        help="run benchmarks whose name starts with this")
+    parser.add_argument('--save', type=str, help="write results to this json file")
+    parser.add_argument('--compare', type=str, help="compare against saved results")
+    return parser.parse_args(args)
+
+@dataclass(kw_only=True)
+class Result():
+    name: str
+    secs: float
+    items: int
+    unit: str
+    nbytes: int = 0
+    peak: int | None = None
+
+    def line(self) -> str:
+        rate = self.items / self.secs if self.secs else float('inf')
+        mbs = f'{self.nbytes / self.secs / 2**20:8.2f} MB/s' if self.nbytes else ' ' * 13
+        peak = f'{self.peak / 2**20:8.2f} MB peak' if self.peak is not None else ''
+        return (f'{self.name:<28} {self.secs * 1000:9.2f} ms '
+                f'{rate:12.0f} {self.unit + "/s":<10} {mbs} {peak}')
+
+def measure(name: str, fn: Callable[[], object], items: int, unit: str,
+            nbytes: int = 0, repeat: int = 3, mem: bool = True) -> Result:
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    peak = None
+    if mem:
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return Result(name=name, secs=best, items=items, unit=unit, nbytes=nbytes, peak=peak)
+
+# -- synthetic captures
+
+def sync_frames(dev: Device) -> list[bytes]:
+    e = Exchange(bp_window=BPWindow())
+    with contextlib.redirect_stdout(io.StringIO()):
+        while (req := e.get_req()) is not None:
+            e.set_res(dev(req))
+    return e.to_frames()
+
+def synth_frames(sessions: int, seed: int = 0) -> list[bytes]:
+    # one simulated device synced `sessions` times, with a few new readings
+    # before each sync
+    rng = random.Random(seed)
+    dev = Device()
+    frames: list[bytes] = []
+    for i in range(sessions):
+        dev.fill(rng.randint(0, 12), seed=seed + i)
+        frames.extend(sync_frames(dev))
+    return frames
+
+class CaptureWriter():
+    # writes frames as a wireshark json export that human.stage_raw accepts,
+    # reusing a real packet as the template for the non-btatt layers
+    CHARS = {name: uuid for uuid, name in human.CHAR_NAMES.items()}
+    SVC = next(iter(human.SVC_NAMES))
+
+    def __init__(self, fp, template: dict):
+        self.fp = fp
+        self.template = template
+        self.first = True
+        self.fp.write('[\n')
+        self._packet({
+            'btatt.opcode': '0x0b',
+            'btatt.handle_tree': {'btatt.service_uuid16': '0x180a',
+                                  'btatt.characteristic_uuid16': '0x2a23'},
+            'btatt.system_id.manufacturer_identifier': '0x000000fffef69c32',
+        })
+
+    def _packet(self, btatt: dict):
+        packet = copy.deepcopy(self.template)
+        packet['_source']['layers']['btatt'] = btatt
+        if not self.first:
+            self.fp.write(',\n')
+        self.first = False
+        self.fp.write(json.dumps(packet, indent=2))
+
+    def _att(self, op: str, char: str, value: bytes):
+        self._packet({
+            'btatt.opcode': op,
+            'btatt.handle_tree': {'btatt.service_uuid128': self.SVC,
+                                  'btatt.uuid128': self.CHARS[char]},
+            'btatt.value': pretty_hex(value),
+        })
+
+    def req(self, raw: bytes):
+        pcs = [raw[i:i + 16] for i in range(0, len(raw), 16)]
+        for i, pc in enumerate(pcs):
+            # all but the last write are confirmed
+            self._att('0x12' if i < len(pcs) - 1 else '0x52', f'i{i:0>2}', pc)
+
+    def res(self, raw: bytes):
+        for i in range(0, len(raw), 16):
+            pc = raw[i:i + 16]
+            self._att('0x1b', f'o{i // 16 % 4:0>2}', pc + bytes(16 - len(pc)))
+
+    def close(self):
+        self.fp.write('\n]\n')
+
+def write_capture(path: Path, frames: list[bytes], template: dict) -> None:
+    with open(path, 'w') as fp:
+        w = CaptureWriter(fp, template)
+        for req, res in zip(frames[::2], frames[1::2]):
+            w.req(req)
+            w.res(res)
+        w.close()
+
+# -- benchmarks
+
+@dataclass(kw_only=True)
+class Corpus():
+    name: str
+    dumps: list[Path]
+    nbytes: int
+    lines: list[list[str]]
+    msgs: list[list[str]]
+
+def load_corpus(name: str, dumps: list[Path]) -> Corpus:
+    lines = []
+    msgs = []
+    for dump in dumps:
+        with open(dump) as fp:
+            ls = list(human.stage_raw(human.iter_packets(fp)))
+        try:
+            ms = human.stage_json(ls)
+        except ValueError:
+            # e.g. 05, several syncs in one capture
+            continue
+        lines.append(ls)
+        msgs.append(ms)
+    return Corpus(name=name, dumps=dumps, lines=lines, msgs=msgs,
+                  nbytes=sum(d.stat().st_size for d in dumps))
+
+def selected(name: str, only: list[str] | None) -> bool:
+    # `--only x10` or `--only stage_json` or `--only x10.stage_json`
+    return not only or any(name.startswith(o) or name.split('.', 1)[1].startswith(o)
+                           for o in only)
+
+def sessions(trans: msg.Transaction) -> list[msg.Transaction]:
+    # a synthetic capture holds many syncs, each starting with M0
+    res: list[msg.Transaction] = []
+    for pair in trans.pairs:
+        if pair.label == 'M0' or not res:
+            res.append(msg.Transaction(pairs=[]))
+        res[-1].pairs.append(pair)
+    return res
+
+def bench_corpus(c: Corpus, repeat: int, mem: bool, only: list[str] | None) -> list[Result]:
+    res = []
+
+    def run(name, *args, **kwargs):
+        name = f'{c.name}.{name}'
+        if selected(name, only):
+            res.append(measure(name, *args, repeat=repeat, mem=mem, **kwargs))
+
+    nlines = sum(len(ls) for ls in c.lines)
+    nframes = sum(len(ms) for ms in c.msgs)
+
+    def raw():
+        for dump in c.dumps:
+            with open(dump) as fp:
+                for _ in human.stage_raw(human.iter_packets(fp)):
+                    pass
+    run('stage_raw', raw, items=nlines, unit='lines', nbytes=c.nbytes)
+
+    run('stage_json', lambda: [human.stage_json(ls) for ls in c.lines],
+        items=nframes, unit='frames')
+
+    transs = [msg.Transaction.from_hex_list(ms) for ms in c.msgs]
+    run('from_hex_list', lambda: [msg.Transaction.from_hex_list(ms) for ms in c.msgs],
+        items=nframes, unit='frames',
+        nbytes=sum(len(m) // 3 + 1 for ms in c.msgs for m in ms))
+
+    items = [item for t in transs for p in t.pairs
+             if isinstance(p.res, msg.MessageResBP) for item in p.res.items]
+    run('to_human', lambda: [item.to_human() for item in items],
+        items=len(items), unit='records')
+
+    # all BP records kept around: Message objects vs one contiguous buffer
+    bp_raws = [bytes(p.res.raw) for ms in c.msgs
+               for p in msg.Transaction.from_hex_list(ms, merge_bp=False).pairs
+               if p.label == 'BP']
+    run('bp_items', lambda: [item for raw in bp_raws
+                             for item in msg.MessageResBP.from_bytes(raw).items],
+        items=len(items), unit='records')
+    run('bp_records', lambda: BPRecords.from_responses(bp_raws),
+        items=len(items), unit='records')
+
+    data = {f'{i:0>4}': s.to_json()
+            for i, s in enumerate(s for t in transs for s in sessions(t))}
+    nleafs = [0]
+
+    def count(path, leaf):
+        nleafs[0] += 1
+    label_fmt.iter_leafs(data, level=0, cb=count)
+
+    def show():
+        obs = label_fmt.Observer([])
+        label_fmt.iter_leafs(data, level=0, cb=obs)
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            obs.show(pad=True)
+    run('label_fmt', show, items=nleafs[0], unit='leafs')
+
+    return res
+
+def bench_exchange(sessions: int, repeat: int, mem: bool) -> Result:
+    devs: list[Device] = []
+
+    def setup():
+        devs.clear()
+        for i in range(sessions):
+            dev = Device()
+            dev.fill(10, seed=i)
+            devs.append(dev)
+
+    def run():
+        for dev in devs:
+            sync_frames(dev)
+
+    best = float('inf')
+    for _ in range(repeat):
+        setup()
+        t0 = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - t0)
+    peak = None
+    if mem:
+        setup()
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return Result(name='sim.exchange', secs=best, items=sessions, unit='sessions', peak=peak)
+
+def compare(results: list[Result], path: str) -> None:
+    base = {r['name']: r for r in json.loads(Path(path).read_bytes())}
+    print(f'\ncompared to {path} (>1 is faster now)')
+    for r in results:
+        b = base.get(r.name)
+        if b is None or not r.items or not b['items']:
+            continue
+        # per item, so runs at different scales are still comparable
+        speedup = (b['secs'] / b['items']) / (r.secs / r.items)
+        mem = ''
+        if r.peak and b.get('peak'):
+            mem = f'  peak mem x{r.peak / b["peak"]:.2f}'
+        print(f'{r.name:<28} x{speedup:6.2f}{mem}')
+
+def main(opts):
+    dumps = sorted(Path(opts.input).glob('*.json'))
+    mem = not opts.no_mem
+    corpora = [load_corpus('corpus', dumps)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if opts.scale:
+            template = json.loads(dumps[0].read_bytes())[0]
+            sessions = opts.scale * len(corpora[0].msgs)
+            path = Path(tmp) / f'synth_x{opts.scale}.json'
+            write_capture(path, synth_frames(sessions), template)
+            corpora.append(load_corpus(f'x{opts.scale}', [path]))
+
+        results = []
+        for c in corpora:
+            results.extend(bench_corpus(c, opts.repeat, mem, opts.only))
+        if selected('sim.exchange', opts.only):
+            results.append(bench_exchange(max(opts.scale, 1) * 10, opts.repeat, mem))
+
+    for r in results:
+        print(r.line())
+    if opts.save:
+        Path(opts.save).write_text(json.dumps([asdict(r) for r in results], indent=2))
+    if opts.compare:
+        compare(results, opts.compare)
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
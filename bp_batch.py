@@ -0,0 +1,92 @@
+import datetime
+from typing import Iterable
+
+import numpy as np
+
+from msg_parser import BP_ITEM_LEN, bp_region
+
+# One BP record (see MessageBPItem), as a numpy structured type so a whole
+# memory read can be decoded without building per-item objects.
+BP_DTYPE = np.dtype([
+    ('dia', 'u1'),
+    ('sys', 'u1'),
+    ('fl1', 'u1'),
+    ('pulse', 'u1'),
+    ('ts', '>u4'),
+    ('fl2', 'u1'),
+    ('c0', 'u1', (2,)),
+    ('pos', 'u1'),
+    ('cs', 'u1', (2,)),
+])
+assert BP_DTYPE.itemsize == BP_ITEM_LEN
+
+def _bits(v: np.ndarray, sb: int, l: int) -> np.ndarray:
+    # vectorized tools.split_i
+    return ((v >> sb) & ((1 << l) - 1)).astype(np.uint8)
+
+def records(buf: bytes | memoryview) -> np.ndarray:
+    if len(buf) % BP_ITEM_LEN != 0:
+        raise ValueError(f"BP record region has {len(buf)} bytes, "
+                         f"not a multiple of {BP_ITEM_LEN}")
+    return np.frombuffer(buf, dtype=BP_DTYPE)
+
+def decode(recs: np.ndarray, year: int | None = None) -> dict[str, np.ndarray]:
+    if year is None:
+        # same as MessageBPItem.to_human, the device doesn't store the year
+        year = datetime.datetime.now().year
+
+    ts = recs['ts']
+    cols = {
+        'sys': recs['sys'].astype(np.int16) + 25,
+        'dia': recs['dia'].copy(),
+        'pulse': recs['pulse'].copy(),
+        'pos': recs['pos'].copy(),
+        'fl1': recs['fl1'].copy(),
+        'fl2': recs['fl2'].copy(),
+        'month': _bits(ts, 26, 4),
+        'day': _bits(ts, 21, 5),
+        'hour': _bits(ts, 16, 5),
+        'minute': _bits(ts, 6, 6),
+        'second': _bits(ts, 0, 6),
+        'cs': recs['cs'][:, 0].astype(np.uint16) << 8 | recs['cs'][:, 1],
+    }
+    months = (np.datetime64(f'{year:04}', 'M')
+              + (cols['month'].astype(np.int64) - 1).astype('timedelta64[M]'))
+    cols['ts'] = (months.astype('datetime64[s]')
+                  + (cols['day'].astype(np.int64) - 1).astype('timedelta64[D]')
+                  + cols['hour'].astype('timedelta64[h]')
+                  + cols['minute'].astype('timedelta64[m]')
+                  + cols['second'].astype('timedelta64[s]'))
+
+    # vectorized msg_parser.bp_record_ok
+    raw = recs.view(np.uint8).reshape(-1, BP_ITEM_LEN)
+    s = raw[:, :12].sum(axis=1, dtype=np.uint32) % 256
+    cols['cs_ok'] = (raw[:, 13] == s) & (raw[:, 12] == 255 - s)
+    return cols
+
+def decode_responses(raws: Iterable[bytes], year: int | None = None) -> dict[str, np.ndarray]:
+    buf = b''.join(bp_region(raw) for raw in raws)
+    return decode(records(buf), year=year)
+
+if __name__ == '__main__':
+    import json
+    import sys
+    from pathlib import Path
+    import msg_parser as msg
+
+    if len(sys.argv) <= 1:
+        print("bp_batch.py FILE.json...", file=sys.stderr)
+        sys.exit(1)
+
+    raws = []
+    for file in sys.argv[1:]:
+        trans = msg.Transaction.from_hex_list(json.loads(Path(file).read_bytes()),
+                                              merge_bp=False)
+        raws.extend(bytes(pair.res.raw) for pair in trans.pairs
+                    if pair.label == 'BP')
+
+    cols = decode_responses(raws)
+    keys = ('pos', 'ts', 'sys', 'dia', 'pulse', 'fl1', 'fl2', 'cs_ok')
+    print(','.join(keys))
+    for row in zip(*(cols[k] for k in keys)):
+        print(','.join(str(v) for v in row))
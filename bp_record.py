@@ -0,0 +1,143 @@
+import datetime
+from typing import Iterable, Iterator, overload
+
+from msg_parser import BP_ITEM_LEN, MessageBPItem, buf_t, bp_intact, bp_record_ok, bp_region
+from tools import split_i
+
+# Compact BP records for long histories. A MessageBPItem is a Message with
+# a Chunk per field and gap (and to_human adds a BPHuman on top), a few KB
+# per reading. BPRecord keeps only the 14 raw bytes and decodes fields when
+# they are read; BPRecords keeps any number of them back to back in a
+# single bytearray and only makes a BPRecord when one is indexed.
+#
+# Fields decode the way MessageBPItem.to_human does: sys is offset by 25
+# and ts gets the current year, the device doesn't store it.
+
+class BPRecord():
+    __slots__ = ('raw',)
+
+    def __init__(self, raw: buf_t):
+        if len(raw) != BP_ITEM_LEN:
+            raise ValueError(f"BP record has {len(raw)} bytes, not {BP_ITEM_LEN}")
+        self.raw = bytes(raw)
+
+    @property
+    def dia(self) -> int: return self.raw[0x00]
+
+    @property
+    def sys(self) -> int: return self.raw[0x01] + 25
+
+    @property
+    def fl1(self) -> int: return self.raw[0x02]
+
+    @property
+    def pulse(self) -> int: return self.raw[0x03]
+
+    @property
+    def ts_i(self) -> int: return int.from_bytes(self.raw[0x04:0x08], 'big')
+
+    @property
+    def fl2(self) -> int: return self.raw[0x08]
+
+    @property
+    def pos(self) -> int: return self.raw[0x0b]
+
+    @property
+    def cs(self) -> int: return self.raw[0x0c] * 256 + self.raw[0x0d]
+
+    @property
+    def ts(self) -> datetime.datetime:
+        return self.timestamp(datetime.datetime.now().year)
+
+    def timestamp(self, year: int) -> datetime.datetime:
+        tsi = self.ts_i
+        return datetime.datetime(year=year, month=split_i(tsi, 26, 4), day=split_i(tsi, 21, 5),
+                                 hour=split_i(tsi, 16, 5), minute=split_i(tsi, 6, 6),
+                                 second=split_i(tsi, 0, 6))
+
+    def cs_ok(self) -> bool:
+        return bp_record_ok(self.raw)
+
+    def to_human(self) -> MessageBPItem.BPHuman:
+        return MessageBPItem.BPHuman(sys=self.sys, dia=self.dia, pulse=self.pulse,
+                                     ts=self.ts, pos=self.pos)
+
+    def to_item(self, idx: int) -> MessageBPItem:
+        # the full Message, e.g. for to_json
+        return MessageBPItem.from_bytes(idx, self.raw)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BPRecord) and self.raw == other.raw
+
+    def __hash__(self) -> int:
+        return hash(self.raw)
+
+    def __repr__(self) -> str:
+        return f'BPRecord({self.raw.hex(":")})'
+
+class BPRecords():
+    __slots__ = ('buf',)
+
+    def __init__(self, buf: buf_t = b''):
+        if len(buf) % BP_ITEM_LEN != 0:
+            raise ValueError(f"BP record region has {len(buf)} bytes, "
+                             f"not a multiple of {BP_ITEM_LEN}")
+        self.buf = bytearray(buf)
+
+    @classmethod
+    def from_responses(cls, raws: Iterable[buf_t]) -> 'BPRecords':
+        # records of BP memory read responses
+        res = cls()
+        for raw in raws:
+            res.buf += bp_region(raw)
+        return res
+
+    def __len__(self) -> int:
+        return len(self.buf) // BP_ITEM_LEN
+
+    @overload
+    def __getitem__(self, i: int) -> BPRecord: ...
+    @overload
+    def __getitem__(self, i: slice) -> 'BPRecords': ...
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return BPRecords(self.buf[start * BP_ITEM_LEN:stop * BP_ITEM_LEN])
+            return BPRecords(b''.join(self.raw(j) for j in range(start, stop, step)))
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("BP record index out of range")
+        return BPRecord(self.raw(i))
+
+    def __iter__(self) -> Iterator[BPRecord]:
+        for i in range(len(self)):
+            yield BPRecord(self.raw(i))
+
+    def raw(self, i: int) -> bytes:
+        return bytes(self.buf[i * BP_ITEM_LEN:(i + 1) * BP_ITEM_LEN])
+
+    def append(self, rec: BPRecord | buf_t) -> None:
+        raw = rec.raw if isinstance(rec, BPRecord) else rec
+        if len(raw) != BP_ITEM_LEN:
+            raise ValueError(f"BP record has {len(raw)} bytes, not {BP_ITEM_LEN}")
+        self.buf += raw
+
+    def extend(self, recs: 'BPRecords | Iterable[BPRecord | buf_t]') -> None:
+        if isinstance(recs, BPRecords):
+            self.buf += recs.buf
+            return
+        for rec in recs:
+            self.append(rec)
+
+    def intact(self) -> int:
+        return bp_intact(self.raw(i) for i in range(len(self)))
+
+    def to_numpy(self):
+        # as a bp_batch.BP_DTYPE array, for bp_batch.decode; copied, so
+        # appending afterwards still works
+        import bp_batch
+        return bp_batch.records(bytes(self.buf))
@@ -0,0 +1,254 @@
+import argparse
+import bisect
+import datetime
+import mmap
+import os
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from bp_record import BPRecord, BPRecords
+from msg_parser import MessageBPItem
+
+# Append-only columnar store for decoded BP measurements.
+#
+#   [block][footer] [block][footer] ...
+#
+# A block holds N rows as fixed width little-endian columns (ts first, rows
+# sorted by ts). Every append writes new blocks followed by a footer
+# indexing just those blocks and pointing back at the previous footer, so
+# older bytes are never rewritten and an append costs the same however big
+# the file is. Readers follow the chain from the end of the file, which
+# ends with the footer size + magic.
+#
+#   footer  := FOOTER_HDR nblocks, prev, BLOCK_ENT * nblocks
+#   trailer := TRAILER footer_sz, MAGIC
+#
+# prev is where the previous trailer ends (0 for the first footer).
+
+MAGIC = b'BPS1'
+FOOTER_HDR = struct.Struct('<4sIQ')
+BLOCK_ENT = struct.Struct('<QIqq')  # offset, nrows, ts_min, ts_max
+TRAILER = struct.Struct('<I4s')
+
+# name -> array typecode, in on-disk order
+COLUMNS: dict[str, str] = {
+    'ts': 'q',
+    'sys': 'H',
+    'dia': 'B',
+    'pulse': 'B',
+    'pos': 'B',
+}
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# anything with ts/sys/dia/pulse/pos
+row_t = MessageBPItem.BPHuman | BPRecord
+
+def to_epoch(ts: datetime.datetime) -> int:
+    # device time has no zone, keep it as-is
+    return int((ts - EPOCH).total_seconds())
+
+def from_epoch(secs: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(seconds=secs)
+
+def _col_sz(name: str) -> int:
+    return array(COLUMNS[name]).itemsize
+
+def _col_offset(name: str, nrows: int) -> int:
+    off = 0
+    for col in COLUMNS:
+        if col == name:
+            return off
+        off += _col_sz(col) * nrows
+    raise KeyError(name)
+
+@dataclass(kw_only=True)
+class Block():
+    offset: int
+    nrows: int
+    ts_min: int
+    ts_max: int
+
+def _trailer(buf, end: int) -> int:
+    # -> start of the footer whose trailer ends at `end`
+    footer_sz, magic = TRAILER.unpack_from(buf, end - TRAILER.size)
+    if magic != MAGIC:
+        raise ValueError("not a bp store (bad trailer)")
+    return end - TRAILER.size - footer_sz
+
+def read_footer(buf) -> list[Block]:
+    # all blocks, oldest first
+    footers: list[list[Block]] = []
+    end = len(buf)
+    while end:
+        start = _trailer(buf, end)
+        magic, nblocks, prev = FOOTER_HDR.unpack_from(buf, start)
+        if magic != MAGIC or prev >= end:
+            raise ValueError("not a bp store (bad footer)")
+        footers.append([Block(**dict(zip(('offset', 'nrows', 'ts_min', 'ts_max'),
+                                         BLOCK_ENT.unpack_from(buf, start + FOOTER_HDR.size + i * BLOCK_ENT.size))))
+                        for i in range(nblocks)])
+        end = prev
+    return [b for blocks in reversed(footers) for b in blocks]
+
+def _map(fp):
+    if os.fstat(fp.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+class Writer():
+    def __init__(self, path: str | Path, batch: int = 4096):
+        self.path = Path(path)
+        self.batch = batch
+        self._rows: list[row_t] = []
+        self.path.touch()
+        with open(self.path, 'rb') as fp:
+            buf = _map(fp)
+            # only the last footer is needed to know this is a store
+            if len(buf):
+                _trailer(buf, len(buf))
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def append(self, row: row_t) -> None:
+        self._rows.append(row)
+        if len(self._rows) >= self.batch:
+            self.flush()
+
+    def extend(self, rows: Iterable[row_t]) -> None:
+        for row in rows:
+            self.append(row)
+
+    def flush(self) -> None:
+        if not self._rows:
+            return
+        rows = sorted(self._rows, key=lambda r: r.ts)
+        self._rows = []
+
+        cols = {name: array(code) for name, code in COLUMNS.items()}
+        for row in rows:
+            cols['ts'].append(to_epoch(row.ts))
+            cols['sys'].append(row.sys)
+            cols['dia'].append(row.dia)
+            cols['pulse'].append(row.pulse)
+            cols['pos'].append(row.pos)
+        if sys.byteorder != 'little':
+            for col in cols.values():
+                col.byteswap()
+
+        with open(self.path, 'ab') as fp:
+            # the previous trailer ends where the new block starts
+            offset = fp.tell()
+            for col in cols.values():
+                col.tofile(fp)
+            block = Block(offset=offset, nrows=len(rows),
+                          ts_min=to_epoch(rows[0].ts), ts_max=to_epoch(rows[-1].ts))
+            footer = b''.join([
+                FOOTER_HDR.pack(MAGIC, 1, offset),
+                BLOCK_ENT.pack(block.offset, block.nrows, block.ts_min, block.ts_max),
+            ])
+            fp.write(footer)
+            fp.write(TRAILER.pack(len(footer), MAGIC))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+class Reader():
+    def __init__(self, path: str | Path):
+        self._fp = open(path, 'rb')
+        self._mm = _map(self._fp)
+        self.blocks = read_footer(self._mm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            try:
+                self._mm.close()
+            except BufferError:
+                # columns from scan() are still around, they keep the map
+                # alive and it's unmapped when the last of them goes
+                pass
+        self._mm = b''
+        self.blocks = []
+        self._fp.close()
+
+    def __len__(self):
+        return sum(b.nrows for b in self.blocks)
+
+    def _column(self, block: Block, name: str):
+        start = block.offset + _col_offset(name, block.nrows)
+        view = memoryview(self._mm)[start:start + _col_sz(name) * block.nrows]
+        if sys.byteorder != 'little':
+            col = array(COLUMNS[name], view)
+            col.byteswap()
+            return col
+        return view.cast(COLUMNS[name])
+
+    def scan(self, ts_from: datetime.datetime | None = None,
+             ts_to: datetime.datetime | None = None,
+             columns: Iterable[str] = COLUMNS) -> Iterator[dict[str, memoryview]]:
+        # -> per matching block, the requested columns limited to
+        # ts_from <= ts < ts_to (only those columns are paged in); they
+        # stay valid after close()
+        lo = to_epoch(ts_from) if ts_from is not None else None
+        hi = to_epoch(ts_to) if ts_to is not None else None
+        columns = list(columns)
+        for block in self.blocks:
+            if lo is not None and block.ts_max < lo:
+                continue
+            if hi is not None and block.ts_min >= hi:
+                continue
+            ts = self._column(block, 'ts')
+            i = bisect.bisect_left(ts, lo) if lo is not None else 0
+            j = bisect.bisect_left(ts, hi) if hi is not None else block.nrows
+            if i < j:
+                yield {name: self._column(block, name)[i:j] for name in columns}
+
+    def rows(self, ts_from: datetime.datetime | None = None,
+             ts_to: datetime.datetime | None = None) -> Iterator[MessageBPItem.BPHuman]:
+        for cols in self.scan(ts_from, ts_to):
+            for ts, sys_, dia, pulse, pos in zip(*(cols[c] for c in COLUMNS)):
+                yield MessageBPItem.BPHuman(sys=sys_, dia=dia, pulse=pulse,
+                                            ts=from_epoch(ts), pos=pos)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser("Append-only store for decoded BP measurements")
+    parser.add_argument('store', type=str, help="store file")
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    add = sub.add_parser('add', help="append BP readings from parsed hex lists")
+    add.add_argument('files', nargs='+', help="parsed/*.json files")
+    scan = sub.add_parser('scan', help="print readings in a time range")
+    scan.add_argument('--from', dest='ts_from', type=datetime.datetime.fromisoformat)
+    scan.add_argument('--to', dest='ts_to', type=datetime.datetime.fromisoformat)
+    return parser.parse_args(args)
+
+def main(opts):
+    if opts.cmd == 'add':
+        import json
+        from msg_parser import Transaction
+        with Writer(opts.store) as w:
+            for file in opts.files:
+                trans = Transaction.from_hex_list(json.loads(Path(file).read_bytes()),
+                                                  merge_bp=False)
+                w.extend(BPRecords.from_responses(pair.res.raw for pair in trans.pairs
+                                                  if pair.label == 'BP'))
+    elif opts.cmd == 'scan':
+        with Reader(opts.store) as r:
+            for row in r.rows(opts.ts_from, opts.ts_to):
+                print(f"bp -- {row}")
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from types import ModuleType
+
+# Content addressed store for stage outputs. A key is the hash of
+# (stage name, stage code version, input hash), so touching a script only
+# invalidates the stages that actually import it, and identical inputs are
+# never parsed twice.
+
+def source_version(*modules: ModuleType) -> str:
+    h = hashlib.sha256()
+    for mod in modules:
+        assert mod.__file__ is not None
+        h.update(Path(mod.__file__).read_bytes())
+    return h.hexdigest()[:16]
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def file_digest(path: Path) -> str:
+    with open(path, 'rb') as fp:
+        return hashlib.file_digest(fp, 'sha256').hexdigest()
+
+class Cache():
+    def __init__(self, root: str | Path, max_bytes: int = 256 << 20):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(stage: str, version: str, input_digest: str) -> str:
+        return digest(f'{stage}\0{version}\0{input_digest}'.encode())
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # bump mtime, eviction drops the least recently used entries
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # several workers may share the store, never expose half a file
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+
+    def evict(self) -> int:
+        if not self.root.is_dir():
+            return 0
+        entries = []
+        total = 0
+        for path in self.root.glob('*/*'):
+            if path.name.startswith('.tmp'):
+                continue
+            st = path.stat()
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def cached(self, stage: str, version: str, input_digest: str, build):
+        key = self.key(stage, version, input_digest)
+        data = self.get(key)
+        if data is None:
+            data = build()
+            self.put(key, data)
+        return data
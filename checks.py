@@ -0,0 +1,161 @@
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+import numpy as np
+
+import msg_parser as msg
+from msg_parser import BP_ITEM_LEN
+
+# Checksum validation over many frames (req, res, req, res, ...) at once.
+# Frames are concatenated into one byte array and every check runs as a
+# handful of numpy operations over all of them:
+#
+# - frame: first byte is the length, xor over all bytes is 0 (`00:xor` tail)
+# - BP records in memory read responses (msg_parser.bp_record_ok)
+# - M1 response timestamp block: same sum + complement, over 14 bytes
+# - long M3 request timestamp block: b[15] = sum(b[:14]), b[14] is M1's
+#   complement byte
+#
+# Every failure is reported, nothing raises.
+
+@dataclass(frozen=True)
+class BadFrame:
+    # index into the frame list
+    frame: int
+    # 'length', 'xor', 'BP', 'M1', 'M3'
+    check: str
+    label: str | None = None
+    # byte offset in the frame of the failing record, if any
+    offset: int | None = None
+
+    def __str__(self) -> str:
+        where = f'@{self.offset:0>2x}' if self.offset is not None else ''
+        return f'frame {self.frame} ({self.label or "?"}): bad {self.check}{where}'
+
+@dataclass(frozen=True)
+class Block:
+    # sum checksummed block: `sz` data bytes followed by [complement, sum]
+    check: str
+    sz: int
+    complement: bool = True
+
+BP_BLOCK = Block(check='BP', sz=BP_ITEM_LEN - 2)
+M1_BLOCK = Block(check='M1', sz=14)
+M3_BLOCK = Block(check='M3', sz=14, complement=False)
+
+def _concat(frames: list[bytes]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    lens = np.fromiter((len(f) for f in frames), dtype=np.int64, count=len(frames))
+    starts = np.zeros(len(frames), dtype=np.int64)
+    np.cumsum(lens[:-1], out=starts[1:])
+    buf = np.frombuffer(b''.join(frames), dtype=np.uint8)
+    return buf, starts, lens
+
+def frame_ok(buf: np.ndarray, starts: np.ndarray, lens: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # (length ok, xor ok) per frame
+    nonempty = lens > 0
+    len_ok = np.zeros(len(lens), dtype=bool)
+    len_ok[nonempty] = buf[starts[nonempty]] == lens[nonempty]
+    xor_ok = np.zeros(len(lens), dtype=bool)
+    if nonempty.any():
+        xor_ok[nonempty] = np.bitwise_xor.reduceat(buf, starts[nonempty]) == 0
+    return len_ok, xor_ok
+
+def block_ok(buf: np.ndarray, offsets: np.ndarray, block: Block) -> np.ndarray:
+    if not len(offsets):
+        return np.zeros(0, dtype=bool)
+    recs = buf[offsets[:, None] + np.arange(block.sz + 2)]
+    s = recs[:, :block.sz].sum(axis=1, dtype=np.uint32) % 256
+    ok = recs[:, -1] == s
+    if block.complement:
+        ok &= recs[:, -2] == 255 - s
+    return ok
+
+def labels(frames: list[bytes]) -> list[str | None]:
+    # label of every frame, from the request of its pair
+    res: list[str | None] = []
+    for req in frames[::2]:
+        kind = msg.kind_from_req(req) if len(req) > 6 else None
+        res.extend([kind.label if kind else None] * 2)
+    return res[:len(frames)]
+
+def validate(frames: list[bytes], records: bool = True) -> list[BadFrame]:
+    if not frames:
+        return []
+    buf, starts, lens = _concat(frames)
+    len_ok, xor_ok = frame_ok(buf, starts, lens)
+    lbls = labels(frames)
+    bad = [BadFrame(frame=int(i), check='length', label=lbls[i])
+           for i in np.flatnonzero(~len_ok)]
+    bad += [BadFrame(frame=int(i), check='xor', label=lbls[i])
+            for i in np.flatnonzero(~xor_ok & len_ok)]
+
+    if records:
+        # (frame, offset) of every checksummed block, only in frames whose
+        # length is right so the blocks are within the frame
+        blocks: dict[Block, tuple[list[int], list[int]]] = {
+            BP_BLOCK: ([], []), M1_BLOCK: ([], []), M3_BLOCK: ([], [])}
+        for i, label in enumerate(lbls):
+            if not len_ok[i]:
+                continue
+            is_res = i % 2 == 1
+            f = frames[i]
+            if label == 'BP' and is_res:
+                n = len(msg.bp_region(f)) // BP_ITEM_LEN
+                blocks[BP_BLOCK][0].extend([i] * n)
+                blocks[BP_BLOCK][1].extend(range(6, 6 + n * BP_ITEM_LEN, BP_ITEM_LEN))
+            elif label == 'M1' and is_res and len(f) >= 6 + M1_BLOCK.sz + 2:
+                blocks[M1_BLOCK][0].append(i)
+                blocks[M1_BLOCK][1].append(6)
+            elif label == 'M3' and not is_res and len(f) > 5 and f[5] == 0x1e:
+                blocks[M3_BLOCK][0].append(i)
+                blocks[M3_BLOCK][1].append(20)
+        for block, (idx, offs) in blocks.items():
+            idx_a = np.array(idx, dtype=np.int64)
+            offs_a = np.array(offs, dtype=np.int64)
+            ok = block_ok(buf, starts[idx_a] + offs_a, block)
+            bad += [BadFrame(frame=idx[j], check=block.check, label=lbls[idx[j]],
+                             offset=offs[j])
+                    for j in np.flatnonzero(~ok)]
+
+    bad.sort(key=lambda b: (b.frame, b.offset or 0))
+    return bad
+
+def checked(frames: Iterable[bytes], batch: int = 256, records: bool = False) -> Iterator[bytes]:
+    # pass frames through, validated `batch` at a time; a batch with bad
+    # frames raises, listing all of them
+    assert batch % 2 == 0, "batches have to hold whole req/res pairs"
+    buf: list[bytes] = []
+    done = 0
+
+    def flush():
+        nonlocal done
+        bad = validate(buf, records=records)
+        if bad:
+            raise ValueError("checksum invalid: " + ', '.join(
+                str(BadFrame(frame=b.frame + done, check=b.check, label=b.label,
+                             offset=b.offset))
+                for b in bad))
+        done += len(buf)
+        yield from buf
+        buf.clear()
+
+    for frame in frames:
+        buf.append(frame)
+        if len(buf) == batch:
+            yield from flush()
+    yield from flush()
+
+if __name__ == '__main__':
+    import sys
+    from frames import load
+
+    if len(sys.argv) <= 1:
+        print("checks.py FILE.json|FILE.frames...", file=sys.stderr)
+        sys.exit(1)
+
+    nbad = 0
+    for file in sys.argv[1:]:
+        for b in validate(load(file)):
+            print(f'{file}: {b}')
+            nbad += 1
+    sys.exit(1 if nbad else 0)
@@ -0,0 +1,160 @@
+import datetime
+import random
+from dataclasses import dataclass, field
+
+import msg_parser as msg
+from proto import BP_ITEM_LEN, BP_START_ADDR, BP_RING_SZ
+from tools import add_checksum, checksum, s_checksum, to_bytes, pretty_hex
+
+# Stateful stand-in for the cuff. Answers M0/M1/BP/M2/M3/M4 requests from
+# its own memory instead of a recorded capture, so an Exchange can be run
+# against any number of readings (see the Readme for the field meanings).
+
+BP_END_ADDR = BP_START_ADDR + BP_RING_SZ * BP_ITEM_LEN
+
+# ts bits that aren't part of the date, 0x1000 is "cuff ok"
+TS_FLAGS = 0x1000
+
+def enc_bp_ts(ts: datetime.datetime, flags: int = TS_FLAGS) -> int:
+    return (ts.month << 26 | ts.day << 21 | ts.hour << 16
+            | ts.minute << 6 | ts.second | flags)
+
+def enc_bp_item(sys: int, dia: int, pulse: int, ts: datetime.datetime, pos: int,
+                fl1: int = 0x58, fl2: int = 0x00) -> bytes:
+    rec = bytes([dia, sys - 25, fl1, pulse,
+                 *enc_bp_ts(ts).to_bytes(4, 'big'),
+                 fl2, 0x00, 0x00, pos % 256])
+    cs = s_checksum(rec)
+    return rec + bytes([255 - cs, cs])
+
+def res_for(req: bytes, payload: bytes) -> bytes:
+    # responses: length, 0x81, echo of req bytes 2:6, payload, 00, xor
+    return add_checksum(bytes([len(payload) + 8, 0x81, *req[2:6], *payload]))
+
+@dataclass(kw_only=True)
+class Device():
+    ring_sz: int = BP_RING_SZ
+    # readings ever taken, the newest one sits in slot (count - 1) % ring_sz
+    count: int = 0
+    pend: int = 0
+    it: int = 0x01
+    fl: int = 0x80
+    # device clock = host clock + offset, M3 sets it
+    clock_offset: datetime.timedelta = datetime.timedelta(0)
+    ring: bytearray = field(default_factory=bytearray)
+
+    def __post_init__(self):
+        if not self.ring:
+            self.ring = bytearray(self.ring_sz * BP_ITEM_LEN)
+
+    @property
+    def last(self) -> int:
+        # 1-based slot of the newest reading
+        return (self.count - 1) % self.ring_sz + 1 if self.count else 0
+
+    def clock(self) -> datetime.datetime:
+        return (datetime.datetime.now() + self.clock_offset).replace(microsecond=0)
+
+    def add_reading(self, sys: int, dia: int, pulse: int,
+                    ts: datetime.datetime | None = None, **kwargs) -> None:
+        slot = self.count % self.ring_sz
+        self.count += 1
+        self.ring[slot * BP_ITEM_LEN:(slot + 1) * BP_ITEM_LEN] = enc_bp_item(
+            sys, dia, pulse, ts or self.clock(), pos=self.last, **kwargs)
+        self.pend = min(self.pend + 1, self.ring_sz)
+
+    def fill(self, n: int, start: datetime.datetime | None = None,
+             step: datetime.timedelta = datetime.timedelta(hours=6),
+             seed: int | None = None) -> None:
+        rng = random.Random(seed)
+        ts = start or self.clock() - step * n
+        for _ in range(n):
+            self.add_reading(sys=rng.randint(95, 160), dia=rng.randint(55, 100),
+                             pulse=rng.randint(50, 110), ts=ts)
+            ts += step
+
+    def __call__(self, req: bytes) -> bytes:
+        if req[0] != len(req) or checksum(req[:-1]) != req[-1]:
+            raise ValueError("bad request " + pretty_hex(req))
+        kind = msg.kind_from_req(req)
+        if kind is None:
+            raise ValueError("unknown request " + pretty_hex(req))
+        return getattr(self, f'_res_{kind.label.lower()}')(req)
+
+    def _res_m0(self, req: bytes) -> bytes:
+        it_cs = to_bytes('01:00:00:01:00', self.it, '00:00:00:00:00:00',
+                         (253 - self.it) % 256, (self.it + 2) % 256)
+        return res_for(req, to_bytes(
+            '80:0f', self.fl, self.last, '00:02',
+            0x80 if self.pend == 0 else 0x00, self.pend,
+            '00:0f:80:00:00', self.last, self.fl,
+            '00:0a:4d:00:0d:00:0b:00:00:00:00:00:00:90:6f', it_cs))
+
+    def _res_m1(self, req: bytes) -> bytes:
+        pc = to_bytes('a0:c0:00:03:00:00:00:00', msg.enc_ts(self.clock()))
+        cs = s_checksum(pc)
+        return res_for(req, to_bytes(pc, 255 - cs, cs))
+
+    def _res_bp(self, req: bytes) -> bytes:
+        addr = req[3] * 256 + req[4]
+        sz = req[5]
+        if addr < BP_START_ADDR or addr + sz > BP_START_ADDR + self.ring_sz * BP_ITEM_LEN:
+            raise ValueError(f"read outside of ring {addr:04x}+{sz}")
+        off = addr - BP_START_ADDR
+        return res_for(req, bytes(self.ring[off:off + sz]))
+
+    def _echo(self, req: bytes) -> bytes:
+        return add_checksum(bytes([req[0], req[1] | 0x80, *req[2:-2]]))
+
+    def _res_m2(self, req: bytes) -> bytes:
+        # the app writes back what it read up to, anything newer stays pending
+        self.fl = req[0x08]
+        self.pend = (self.last - req[0x09]) % self.ring_sz if self.count else 0
+        return self._echo(req)
+
+    def _res_m3(self, req: bytes) -> bytes:
+        self.it = req[0x0b]
+        if req[0x05] == 0x1e:
+            ts = msg.dec_ts(req[0x1c:0x22])
+            self.clock_offset = ts - datetime.datetime.now()
+        return self._echo(req)
+
+    def _res_m4(self, req: bytes) -> bytes:
+        return self._echo(req)
+
+if __name__ == '__main__':
+    import argparse
+    import asyncio
+    import contextlib
+    import io
+    import sys
+    import time
+    from metrics import Metrics
+    from proto import Exchange, BPWindow
+    from transport import LoopbackTransport, run_exchange
+
+    parser = argparse.ArgumentParser("Sync against a simulated device")
+    parser.add_argument('-n', type=int, default=20, help="readings to fill in")
+    parser.add_argument('--window', type=int, default=4, help="max records per read")
+    parser.add_argument('--adaptive', action='store_true')
+    parser.add_argument('--metrics', action='store_true', help="print per message timings")
+    parser.add_argument('--trace', type=str, help="write per message timings (json lines)")
+    opts = parser.parse_args(sys.argv[1:])
+
+    dev = Device()
+    dev.fill(opts.n, seed=0)
+    e = Exchange(bp_window=BPWindow(max_items=opts.window, adaptive=opts.adaptive))
+    if opts.metrics or opts.trace:
+        e.metrics = Metrics(keep_events=bool(opts.trace))
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        asyncio.run(run_exchange(LoopbackTransport(dev), e))
+    dt = time.perf_counter() - t0
+    print(f"{out.getvalue().count('bp --')} readings, {len(e.pairs)} messages, "
+          f"{dt * 1000:.1f}ms, pending after sync {dev.pend}")
+    if e.metrics is not None:
+        print(e.metrics.summary())
+    if opts.trace:
+        assert e.metrics is not None
+        with open(opts.trace, 'w') as fp:
+            e.metrics.write_jsonl(fp)
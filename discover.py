@@ -0,0 +1,322 @@
+import argparse
+import json
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+import checks
+import frames
+import msg_parser as msg
+from msg_parser import BP_ITEM_LEN
+
+# Automated version of the "non-consts" tables in the Readme: every message
+# of a kind (label, req/res, length) across the corpus goes into one byte
+# matrix, which is then searched for
+#
+# - offsets that vary, and the values they take
+# - pairwise relations between varying offsets: a == b, b == a + k,
+#   a + b == k (mod 256), b = f(a)
+# - sum checksums: x == sum(msg[a:e]) + k or x + sum(msg[a:e]) == k, with
+#   x right after the block (or one byte later)
+# - a candidate Layout: the known ProtoChunks plus runs of varying bytes
+#   nobody has named yet, ready to paste into msg_parser.py
+#
+# BP records are analysed on their own (label BP, io item).
+
+def parse_args(args):
+    parser = argparse.ArgumentParser("Find the non-constant fields of every message kind")
+    parser.add_argument('input', nargs='*', default=['parsed'],
+                        help="frame files (.json/.frames) or directories with them")
+    parser.add_argument('--label', type=str, action='append', help="only these labels")
+    parser.add_argument('--io', type=str, choices=('req', 'res', 'item'))
+    parser.add_argument('--rows', type=int, default=30,
+                        help="rows of the non-consts table to print (0 = all)")
+    parser.add_argument('--max-values', type=int, default=8,
+                        help="list the values of offsets with at most this many")
+    parser.add_argument('--json', action='store_true', help="output json")
+    return parser.parse_args(args)
+
+@dataclass(kw_only=True)
+class Group:
+    label: str
+    io: str
+    size: int
+    ids: list[str] = field(default_factory=list)
+    rows: list[bytes] = field(default_factory=list)
+
+    @property
+    def name(self) -> str:
+        return f'{self.label}.{self.io}[{self.size}]'
+
+def input_files(inputs: list[str]) -> list[Path]:
+    files: list[Path] = []
+    for inp in map(Path, inputs):
+        if inp.is_dir():
+            files.extend(sorted([*inp.glob('*.json'), *inp.glob('*.frames')]))
+        else:
+            files.append(inp)
+    return files
+
+def collect(files: list[Path]) -> dict[tuple[str, str, int], Group]:
+    groups: dict[tuple[str, str, int], Group] = {}
+
+    def add(label, io, id, raw):
+        key = (label, io, len(raw))
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = Group(label=label, io=io, size=len(raw))
+        g.ids.append(id)
+        g.rows.append(raw)
+
+    for file in files:
+        id = file.name.rsplit('.', 1)[0].replace('.', ':')
+        fs = frames.load(file)
+        seen: dict[tuple[str, str], int] = {}
+        items = 0
+        for i, (label, raw) in enumerate(zip(checks.labels(fs), fs)):
+            label = label or '?'
+            io = 'req' if i % 2 == 0 else 'res'
+            if label == 'BP' and io == 'res':
+                region = msg.bp_region(raw)
+                for j in range(0, len(region), BP_ITEM_LEN):
+                    add('BP', 'item', f'{id}.{items:0>2}', bytes(region[j:j + BP_ITEM_LEN]))
+                    items += 1
+                continue
+            n = seen[label, io] = seen.get((label, io), 0) + 1
+            add(label, io, id if n == 1 else f'{id}#{n}', raw)
+    return groups
+
+def known_fields(g: Group) -> list[tuple[int, int, str]]:
+    # (start, sz, label) of the fields msg_parser already knows
+    if g.io == 'item':
+        m: msg.Message = msg.MessageBPItem.from_bytes(0, g.rows[0])
+    else:
+        kind = msg.KINDS.get(g.label)
+        if kind is None:
+            return []
+        m = (kind.build_req if g.io == 'req' else kind.build_res)(g.rows[0])
+    return [(c.start, c.sz, c.label) for c in m.chunks if not c.label.startswith('$')]
+
+@dataclass(kw_only=True)
+class Report:
+    group: Group
+    varying: list[int]
+    names: dict[int, str]
+    values: dict[int, list[int]]
+    relations: list[str]
+    checksums: list[str]
+    layout: list[tuple[int, int, str, str]]
+
+def offset_names(known: list[tuple[int, int, str]], size: int) -> dict[int, str]:
+    names = {off: f'{off:0>2x}' for off in range(size)}
+    for start, sz, label in known:
+        for i in range(sz):
+            names[start + i] = label if sz == 1 else f'{label}.{i}'
+    return names
+
+def relations(M: np.ndarray, varying: list[int], names: dict[int, str], ids: list[str],
+              tolerance: float = 0.1, chunk: int = 4096) -> list[str]:
+    n, k = len(M), len(varying)
+    if n < 3 or k < 2:
+        return []
+    V = M[:, varying].astype(np.int64)
+    tol = int(n * tolerance)
+    # (a + b) % 256 and (b - a) % 256 histograms of every pair, so a
+    # relation broken by a few odd captures is still found
+    pair = (np.arange(k)[:, None] * k + np.arange(k)[None, :]) * 256
+    h_sum = np.zeros(k * k * 256, dtype=np.int64)
+    h_diff = np.zeros(k * k * 256, dtype=np.int64)
+    for i in range(0, n, chunk):
+        A = V[i:i + chunk, :, None]
+        B = V[i:i + chunk, None, :]
+        h_sum += np.bincount((pair + (A + B) % 256).ravel(), minlength=k * k * 256)
+        h_diff += np.bincount((pair + (B - A) % 256).ravel(), minlength=k * k * 256)
+    h_sum = h_sum.reshape(k, k, 256)
+    h_diff = h_diff.reshape(k, k, 256)
+    distinct = [len(np.unique(V[:, a])) for a in range(k)]
+    npairs = np.array([[len(np.unique(V[:, a] * 256 + V[:, b])) for b in range(k)]
+                       for a in range(k)])
+
+    def name(a):
+        return names[varying[a]]
+
+    def but(a, b, ok):
+        bad = [ids[i] for i in np.flatnonzero(~ok)]
+        return f' (except {" ".join(bad)})' if bad else ''
+
+    res = []
+    linked = set()
+    for a in range(k):
+        for b in range(a + 1, k):
+            d = int(h_diff[a, b].argmax())
+            sm = int(h_sum[a, b].argmax())
+            # with two values any bijection is "linear", only == means anything
+            wide = min(distinct[a], distinct[b]) > 2 + (1 if tol else 0)
+            if h_diff[a, b, d] == n and d == 0 or wide and h_diff[a, b, d] >= n - tol:
+                ok = (V[:, b] - V[:, a]) % 256 == d
+                rel = f'{name(a)} == {name(b)}' if d == 0 else f'{name(b)} == {name(a)} + {d:#04x}'
+                res.append(rel + but(a, b, ok))
+            elif wide and h_sum[a, b, sm] >= n - tol:
+                ok = (V[:, a] + V[:, b]) % 256 == sm
+                res.append(f'{name(a)} + {name(b)} == {sm:#04x}' + but(a, b, ok))
+            else:
+                continue
+            linked |= {a, b}
+
+    # offsets that always change together (one is a bijection of the other)
+    cluster = list(range(k))
+
+    def find(a):
+        while cluster[a] != a:
+            a = cluster[a]
+        return a
+    for a in range(k):
+        for b in range(a + 1, k):
+            if npairs[a, b] == distinct[a] == distinct[b]:
+                cluster[find(b)] = find(a)
+    groups: dict[int, list[int]] = {}
+    for a in range(k):
+        groups.setdefault(find(a), []).append(a)
+    for members in groups.values():
+        if len(members) > 1 and not set(members) <= linked:
+            res.append(' '.join(name(a) for a in members) + ' change together')
+
+    # b = f(a), a repeating often enough for that to mean something
+    reps = sorted(groups)
+    for a in reps:
+        for b in reps:
+            if a != b and npairs[a, b] == distinct[a] > distinct[b] and distinct[a] * 2 <= n:
+                mapping = ''
+                if distinct[a] <= 4:
+                    pairs = np.unique(V[:, a] * 256 + V[:, b])
+                    mapping = ': ' + ', '.join(f'{p >> 8:0>2x}->{p & 0xff:0>2x}' for p in pairs)
+                res.append(f'{name(b)} = f({name(a)}){mapping}')
+    return res
+
+def checksums(M: np.ndarray, varying: list[int], names: dict[int, str]) -> list[str]:
+    if len(M) < 3:
+        return []
+    P = np.zeros((M.shape[0], M.shape[1] + 1), dtype=np.int64)
+    np.cumsum(M, axis=1, out=P[:, 1:])
+    var = np.zeros(M.shape[1] + 1, dtype=np.int64)
+    var[1:][varying] = 1
+    nvar = np.cumsum(var)
+    res = []
+    for c in varying:
+        col = M[:, c:c + 1].astype(np.int64)
+        found = None
+        for e in (c, c - 1):
+            if e < 2:
+                continue
+            # S[:, a] = sum(msg[a:e]), only blocks with >= 2 other varying bytes
+            S = (P[:, e:e + 1] - P[:, :e]) % 256
+            enough = (nvar[e] - nvar[:e] - (1 if c < e else 0)) >= 2
+            for form, T in (('sum', (col - S) % 256), ('+', (col + S) % 256)):
+                ok = (T == T[0]).all(axis=0) & enough
+                for a in np.flatnonzero(ok)[::-1]:
+                    k = int(T[0, a])
+                    exact = (form == 'sum' and k == 0) or (form == '+' and k == 255)
+                    # exact sums first, then the shortest block, then the
+                    # block ending right before the checksum
+                    cand = (not exact, e - int(a), c - e, form, k)
+                    if found is None or cand < found:
+                        found = cand
+                    break
+        if found is not None:
+            _, length, gap, form, k = found
+            e = c - gap
+            block = f'sum(msg[{e - length:#04x}:{e:#04x}])'
+            if form == 'sum':
+                res.append(f'{names[c]} == {block}' + (f' + {k:#04x}' if k else ''))
+            elif k == 255:
+                res.append(f'{names[c]} == 255 - {block}')
+            else:
+                res.append(f'{names[c]} + {block} == {k:#04x}')
+    return res
+
+def candidate_layout(known: list[tuple[int, int, str]], varying: list[int]
+                     ) -> list[tuple[int, int, str, str]]:
+    # (start, sz, label, comment)
+    covered = {start + i for start, sz, _ in known for i in range(sz)}
+    vset = set(varying)
+    res = [(start, sz, label, '' if vset & set(range(start, start + sz)) else 'const in corpus')
+           for start, sz, label in known]
+    run: list[int] = []
+    for off in [*sorted(vset - covered), -1]:
+        if run and off != run[-1] + 1:
+            res.append((run[0], len(run), f'v{run[0]:0>2x}', 'new'))
+            run = []
+        run.append(off)
+    return sorted(res)
+
+def analyze(g: Group) -> Report:
+    M = np.frombuffer(b''.join(g.rows), dtype=np.uint8).reshape(-1, g.size)
+    # frames: leave out length/io and the 00:xor tail
+    lo, hi = (0, g.size) if g.io == 'item' else (2, g.size - 2)
+    varying = [int(off) for off in np.flatnonzero((M != M[0]).any(axis=0)) if lo <= off < hi]
+    known = known_fields(g)
+    names = offset_names(known, g.size)
+    return Report(
+        group=g, varying=varying, names=names,
+        values={off: np.unique(M[:, off]).tolist() for off in varying},
+        relations=relations(M, varying, names, g.ids),
+        checksums=checksums(M, varying, names),
+        layout=candidate_layout(known, varying))
+
+def layout_src(layout: list[tuple[int, int, str, str]]) -> str:
+    lines = ['    LAYOUT: ClassVar[Layout] = Layout(chunks=(']
+    for start, sz, label, comment in layout:
+        line = f"        ProtoChunk(start={start:#04x}, sz={sz}, label='{label}'),"
+        lines.append(line + (f'  # {comment}' if comment else ''))
+    lines.append('    ))')
+    return '\n'.join(lines)
+
+def show(r: Report, rows: int, max_values: int) -> None:
+    g = r.group
+    print(f'## {g.name}: {len(g.rows)} messages, {len(r.varying)} varying offsets')
+    if r.varying:
+        cols = [r.names[off] for off in r.varying]
+        id_w = max(len(id) for id in g.ids)
+        print(' ' * id_w, ' '.join(f'{c:<2}' for c in cols))
+        for id, raw in list(zip(g.ids, g.rows))[:rows or None]:
+            print(f'{id:<{id_w}}', ' '.join(f'{raw[off]:0>2x}'.ljust(max(len(c), 2))
+                                           for off, c in zip(r.varying, cols)))
+        if rows and len(g.rows) > rows:
+            print(f'... {len(g.rows) - rows} more')
+        print()
+        for off in r.varying:
+            vals = r.values[off]
+            vs = (' '.join(f'{v:0>2x}' for v in vals) if len(vals) <= max_values
+                  else f'{len(vals)} values {vals[0]:0>2x}..{vals[-1]:0>2x}')
+            print(f'{r.names[off]} @{off:0>2x}: {vs}')
+    for line in r.relations + r.checksums:
+        print(line)
+    print(layout_src(r.layout))
+    print()
+
+def to_json(r: Report) -> dict:
+    return {
+        'label': r.group.label, 'io': r.group.io, 'size': r.group.size,
+        'count': len(r.group.rows),
+        'varying': {r.names[off]: {'offset': off, 'values': r.values[off]} for off in r.varying},
+        'relations': r.relations,
+        'checksums': r.checksums,
+        'layout': [{'start': s, 'sz': sz, 'label': label, 'comment': c}
+                   for s, sz, label, c in r.layout],
+    }
+
+def main(opts):
+    groups = collect(input_files(opts.input))
+    reports = [analyze(g) for key, g in sorted(groups.items())
+               if (not opts.label or g.label in opts.label)
+               and (not opts.io or g.io == opts.io)]
+    if opts.json:
+        print(json.dumps([to_json(r) for r in reports], indent=2))
+        return
+    for r in reports:
+        show(r, opts.rows, opts.max_values)
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,76 @@
+import io
+import json
+import struct
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator
+
+from tools import pretty_hex
+
+# Binary container for reassembled messages (req, res, req, res, ...):
+#
+#   MAGIC, then per frame: u16le length, frame bytes
+#
+# The old colon-hex json list (parsed/*.json) is still readable and can be
+# produced with `dumps(frames, fmt='json')`.
+#
+# Many captures fit in one ndjson file, a line per capture:
+#
+#   {"id": "05:a", "frames": ["0801000260...", ...]}
+
+MAGIC = b'OMRF\x01'
+FRAME_HDR = struct.Struct('<H')
+
+def write_frames(fp: BinaryIO, frames: Iterable[bytes]) -> None:
+    fp.write(MAGIC)
+    for frame in frames:
+        fp.write(FRAME_HDR.pack(len(frame)))
+        fp.write(frame)
+
+def read_frames(fp: BinaryIO) -> Iterator[bytes]:
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a frame file")
+    while True:
+        hdr = fp.read(FRAME_HDR.size)
+        if not hdr:
+            return
+        if len(hdr) != FRAME_HDR.size:
+            raise ValueError("truncated frame header")
+        (sz,) = FRAME_HDR.unpack(hdr)
+        frame = fp.read(sz)
+        if len(frame) != sz:
+            raise ValueError("truncated frame")
+        yield frame
+
+def dumps_line(id: str, frames: Iterable[bytes]) -> str:
+    return json.dumps({'id': id, 'frames': [f.hex() for f in frames]}) + '\n'
+
+def loads_line(line: str | bytes) -> tuple[str, list[bytes]]:
+    data = json.loads(line)
+    return data['id'], [bytes.fromhex(f) for f in data['frames']]
+
+def iter_lines(path: str | Path) -> Iterator[tuple[str, list[bytes]]]:
+    with open(path, 'rb') as fp:
+        for line in fp:
+            if line.strip():
+                yield loads_line(line)
+
+def from_hex(msg: str) -> bytes:
+    return bytes.fromhex(msg.replace(':', ''))
+
+def dumps(frames: Iterable[bytes], fmt: str = 'frames') -> bytes:
+    if fmt == 'json':
+        # same as `print(json.dumps(..., indent=2))` in the stage scripts
+        return (json.dumps([pretty_hex(f) for f in frames], indent=2) + '\n').encode()
+    elif fmt == 'frames':
+        buf = io.BytesIO()
+        write_frames(buf, frames)
+        return buf.getvalue()
+    raise ValueError(f"unknown frame format {fmt}")
+
+def loads(data: bytes) -> list[bytes]:
+    if data.startswith(MAGIC):
+        return list(read_frames(io.BytesIO(data)))
+    return [from_hex(msg) for msg in json.loads(data)]
+
+def load(path: str | Path) -> list[bytes]:
+    return loads(Path(path).read_bytes())
@@ -1,14 +1,22 @@
 import argparse
 import json
 import sys
+from typing import Iterable
 from pathlib import Path
-from tools import verify_cs, exp_len, join, ints, safe_truncate
+from tools import pretty_hex
+import checks
+import frames
+import msg_parser
+from msg_parser import BP_ITEM_LEN
 
 def parse_args(args):
     parser = argparse.ArgumentParser("Convert json bt packet dump to human readable")
     parser.add_argument("file", nargs=1, help="json packet dump file")
     parser.add_argument("--hex", action='store_true', help="output for hex editor")
+    parser.add_argument("--index", type=str,
+                        help="with --hex, write the offset of every message to this json file")
     parser.add_argument("--json", action='store_true', help="output json msgs")
+    parser.add_argument("--frames", action='store_true', help="output msgs as binary frames")
     return parser.parse_args(args)
 
 def get(obj, path, default=None):
@@ -29,22 +37,84 @@ def fixup(svc, char, uuid):
     else:
         return (svc, char, uuid)
 
+SVC_NAMES = {
+    'ec:be:39:80:c9:a2:11:e1:b1:bd:00:02:a5:d5:c5:1b': 'ecbe-',
+}
+
+CHAR_NAMES = {
+    '49:12:30:40:ae:e8:11:e1:a7:4d:00:02:a5:d5:c5:1b': 'o00',
+    '4d:0b:f3:20:ae:e8:11:e1:a0:d9:00:02:a5:d5:c5:1b': 'o01',
+    '51:28:ce:60:ae:e8:11:e1:b8:4b:00:02:a5:d5:c5:1b': 'o02',
+    '56:0f:14:20:ae:e8:11:e1:81:84:00:02:a5:d5:c5:1b': 'o03',
+    'db:5b:55:e0:ae:e7:11:e1:96:5e:00:02:a5:d5:c5:1b': 'i00',
+    'e0:b8:a0:60:ae:e7:11:e1:92:f4:00:02:a5:d5:c5:1b': 'i01',
+    '0a:e1:2b:00:ae:e8:11:e1:a1:92:00:02:a5:d5:c5:1b': 'i02',
+    'b3:05:b6:80:ae:e7:11:e1:a7:30:00:02:a5:d5:c5:1b': 'setup',
+}
+
 def human_svc(svc):
-    return {
-        'ec:be:39:80:c9:a2:11:e1:b1:bd:00:02:a5:d5:c5:1b': 'ecbe-',
-    }.get(svc, svc)
+    return SVC_NAMES.get(svc, svc)
 
 def human_char(char):
-    return {
-        '49:12:30:40:ae:e8:11:e1:a7:4d:00:02:a5:d5:c5:1b': 'o00',
-        '4d:0b:f3:20:ae:e8:11:e1:a0:d9:00:02:a5:d5:c5:1b': 'o01',
-        '51:28:ce:60:ae:e8:11:e1:b8:4b:00:02:a5:d5:c5:1b': 'o02',
-        '56:0f:14:20:ae:e8:11:e1:81:84:00:02:a5:d5:c5:1b': 'o03',
-        'db:5b:55:e0:ae:e7:11:e1:96:5e:00:02:a5:d5:c5:1b': 'i00',
-        'e0:b8:a0:60:ae:e7:11:e1:92:f4:00:02:a5:d5:c5:1b': 'i01',
-        '0a:e1:2b:00:ae:e8:11:e1:a1:92:00:02:a5:d5:c5:1b': 'i02',
-        'b3:05:b6:80:ae:e7:11:e1:a7:30:00:02:a5:d5:c5:1b': 'setup',
-    }.get(char, char)
+    return CHAR_NAMES.get(char, char)
+
+def iter_packets(fp, chunk_sz=1 << 16):
+    # walk the top-level array of a wireshark json export one packet at a
+    # time, so we never hold more than a packet (+ a read chunk) in memory
+    dec = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = fp.read(max(chunk_sz, len(buf) - pos))
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    skip_ws()
+    if buf[pos:pos+1] != '[':
+        raise ValueError("expected a json array of packets")
+    pos += 1
+    first = True
+    while True:
+        skip_ws()
+        if pos >= len(buf):
+            raise ValueError("unterminated packet array")
+        if buf[pos] == ']':
+            return
+        if not first:
+            if buf[pos] != ',':
+                raise ValueError(f"expected ',' between packets, got {buf[pos]!r}")
+            pos += 1
+            skip_ws()
+        first = False
+        while True:
+            try:
+                packet, end = dec.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            # a packet ending exactly at the buffer edge might be a truncated
+            # scalar, make sure there's something after it
+            if end >= len(buf) and not eof:
+                fill()
+                continue
+            break
+        pos = end
+        yield packet
 
 def stage_raw(packets):
     for packet in packets:
@@ -88,85 +158,167 @@ def stage_raw(packets):
 
         yield f"{op} {cmd} {human_svc(svc)} {human_char(char)} {ccc} -- {value}"
 
-def stage_hex(lines):
-    before = True
+HEX_ROW = 16
+
+def stage_hex(lines, index: list[dict] | None = None):
+    # One 16 byte row per fragment (zero padded), plus an 'input'/'output'
+    # row whenever the direction changes. With `index`, an entry per
+    # reassembled frame (same order as iter_frames) is appended to it:
+    #   frame, label, io (req/res), size, rows ([offset, bytes] per fragment)
+    # and for BP responses the number of the first item (as in parsed2/).
+    lines = iter(lines)
     for line in lines:
         if 'btatt.system_id.manufacturer_identifier' in line:
             break
 
-    def pad(sth, pad_len=16):
+    def pad(sth, pad_len=HEX_ROW):
         return sth + bytes([0]) * (pad_len - len(sth))
 
     def to_bin(txt):
         return pad(txt.encode('utf-8'))
 
+    offset = 0
+    pending: dict[str, tuple[dict, bytearray]] = {}
+    req_label = None
+    bp_items = 0
+
+    def add_to_index(line, raw_data):
+        nonlocal req_label, bp_items
+        op, cmd, svc, char, ccc, _, val = line.split()
+        if val == '01:00:ff:ff':
+            return
+        if char[0] not in pending:
+            entry = {'frame': None, 'label': None, 'io': 'req' if char[0] == 'i' else 'res',
+                     'size': raw_data[0], 'rows': []}
+            pending[char[0]] = (entry, bytearray())
+        entry, buf = pending[char[0]]
+        n = min(len(raw_data), entry['size'] - len(buf))
+        entry['rows'].append([offset, n])
+        buf += raw_data[:n]
+        if len(buf) < entry['size']:
+            return
+        del pending[char[0]]
+        if entry['io'] == 'req':
+            kind = msg_parser.kind_from_req(bytes(buf))
+            req_label = kind.label if kind else None
+        entry['label'] = req_label
+        if req_label == 'BP' and entry['io'] == 'res':
+            entry['item'] = bp_items
+            bp_items += buf[5] // BP_ITEM_LEN
+        entry['frame'] = len(index)
+        index.append(entry)
+
     crnt = 'i'
     yield to_bin('input')
+    offset += HEX_ROW
     for line in lines:
+        if not line:
+            continue
         io = line[17]
         if io != crnt:
             crnt = io
             yield to_bin('input' if io == 'i' else 'output')
+            offset += HEX_ROW
 
         data = line[29:]
         raw_data = bytes(int(d, 16) for d in data.split(':'))
+        if index is not None:
+            add_to_index(line, raw_data)
         yield pad(raw_data)
+        offset += HEX_ROW
 
-def stage_json(lines):
+class HexIndex():
+    # stage_hex index, to find a label_fmt leaf in the hex dump
+    def __init__(self, frames: list[dict]):
+        self.by_msg: dict[tuple[str, str], list[dict]] = {}
+        for entry in frames:
+            self.by_msg.setdefault((entry['label'], entry['io']), []).append(entry)
+
+    @classmethod
+    def load(cls, path: str | Path) -> 'HexIndex':
+        return cls(json.loads(Path(path).read_bytes())['frames'])
+
+    def offset(self, path: list[str], start: int) -> int:
+        # hex dump offset of byte `start` of the leaf at `path` (id, msg,
+        # io, [bpid,] label)
+        entries = self.by_msg.get((path[1], path[2]))
+        if not entries:
+            raise KeyError('.'.join(path))
+        entry = entries[0]
+        if len(path) == 5:
+            item = int(path[3])
+            entry = next(e for e in reversed(entries) if e['item'] <= item)
+            start += 6 + (item - entry['item']) * BP_ITEM_LEN
+        for row, n in entry['rows']:
+            if start < n:
+                return row + start
+            start -= n
+        raise KeyError('.'.join(path))
+
+def iter_frames(lines):
+    # Reassemble messages from the write/notification fragments, one buffer
+    # per direction (i0N writes, o0N notifications). A message is yielded
+    # as soon as its length (first byte) is reached, whatever is left of
+    # the fragment is padding and has to be zeros.
     lines = iter(lines)
-    before = True
     for line in lines:
         if 'btatt.system_id.manufacturer_identifier' in line:
             break
 
-
-    msgs = []
-    def accum_val(val):
-        if not msgs or exp_len(msgs[-1]) <= len(msgs[-1]):
-            msgs.append(val)
-        else:
-            msgs[-1] = join(msgs[-1], val)
-
+    bufs: dict[str, bytearray] = {}
     for line in lines:
         if not line:
             continue
         op, cmd, svc, char, ccc, _, val = line.split()
-        if val != '01:00:ff:ff':
-            accum_val(val)
-
-    msgs = [safe_truncate(msg) for msg in msgs]
-    if not all(verify_cs(ints(msg)) for msg in msgs):
-        raise ValueError("checksum invalid")
+        if val == '01:00:ff:ff':
+            continue
+        buf = bufs.get(char[0])
+        if buf is None:
+            buf = bufs[char[0]] = bytearray()
+        buf += frames.from_hex(val)
+        need = buf[0]
+        if len(buf) >= need:
+            if not need or buf.count(0, need) != len(buf) - need:
+                raise ValueError("Can't truncate " + pretty_hex(buf))
+            yield bytes(buf[:need])
+            buf.clear()
 
-    return msgs
+    for buf in bufs.values():
+        if buf:
+            raise ValueError("truncated message " + pretty_hex(buf))
 
-def main(opts):
-    was_raw = None
-    if opts.file[0].endswith('.json'):
-        was_raw = True
-        # packet capture?
-        packets = json.loads(Path(opts.file[0]).read_bytes())
-        parsed = stage_raw(packets)
-    elif opts.file[0].endswith('.txt'):
-        # raw parsed
-        parsed = Path(opts.file[0]).read_text().split('\n')
-        was_raw = False
-    else:
-        raise Exception("not sure what to do with input file")
+def stage_json(lines):
+    return [pretty_hex(frame) for frame in checks.checked(iter_frames(lines))]
 
+def write_output(opts, parsed: Iterable[str], was_raw: bool) -> None:
     if opts.hex:
-        res = stage_hex(parsed)
-        fres = b''.join(res)
-        sys.stdout.buffer.write(fres)
+        index = [] if opts.index else None
+        with open(sys.stdout.fileno(), 'wb', buffering=1 << 20, closefd=False) as out:
+            for row in stage_hex(parsed, index):
+                out.write(row)
+        if opts.index:
+            Path(opts.index).write_text(json.dumps({'row': HEX_ROW, 'frames': index}))
+    elif opts.frames:
+        frames.write_frames(sys.stdout.buffer, checks.checked(iter_frames(parsed)))
     elif opts.json or not was_raw:
         # assume we want json if the input is parsed
         res = stage_json(parsed)
         print(json.dumps(res, indent=2))
-    elif was_raw:
-        fres = '\n'.join(parsed)
-        print(fres)
     else:
-        raise Exception("don't know what to do")
+        for line in parsed:
+            print(line)
+
+def main(opts):
+    if opts.file[0].endswith('.json'):
+        # packet capture, the stages read it lazily so it stays open until
+        # the output is written
+        with open(opts.file[0], 'r', encoding='utf-8') as fp:
+            write_output(opts, stage_raw(iter_packets(fp)), was_raw=True)
+    elif opts.file[0].endswith('.txt'):
+        # raw parsed
+        write_output(opts, Path(opts.file[0]).read_text().split('\n'), was_raw=False)
+    else:
+        raise Exception("not sure what to do with input file")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import signal
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import label_fmt
+
+# Keeps the leaves of parsed2/ files (chunked json or just frames) loaded
+# between label_fmt queries.
+# Queries are label_fmt.py arguments sent over a unix socket (see lq.py).
+# Files are loaded on first use and re-read when their size/mtime changed;
+# the directories queried so far are also re-checked every --poll seconds,
+# so new captures are usually loaded before anybody asks for them.
+
+DEFAULT_SOCKET = os.environ.get('LABEL_FMT_SOCKET', '.cache/label_fmt.sock')
+
+def parse_args(args):
+    parser = argparse.ArgumentParser("serve label_fmt queries from memory")
+    parser.add_argument('-i', '--input', type=str, action='append',
+                        help="directory to preload and watch (default parsed2)")
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET)
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help="seconds between checks for changed files")
+    return parser.parse_args(args)
+
+def file_stat(file: Path) -> tuple[int, int]:
+    st = file.stat()
+    return st.st_size, st.st_mtime_ns
+
+@dataclass
+class Entry():
+    stat: tuple[int, int]
+    # (leaf_key, path, leaf) in iter_leafs order
+    leafs: list[tuple[tuple, list[str], dict]]
+
+class Corpus():
+    def __init__(self):
+        self.files: dict[Path, Entry] = {}
+        self.dirs: set[Path] = set()
+        # file -> (stat, error) of the last failed load, e.g. a file that is
+        # still being written; retried when polled again
+        self.failed: dict[Path, tuple[tuple[int, int] | None, str]] = {}
+        # dir -> files label_fmt.input_files left out, logged when they change
+        self.skipped: dict[Path, dict[Path, Path]] = {}
+
+    def _load(self, file: Path, stat: tuple[int, int]) -> Entry:
+        leafs = [(label_fmt.leaf_key(path), path, leaf)
+                 for path, leaf in label_fmt.file_leafs(file)]
+        entry = self.files[file] = Entry(stat=stat, leafs=leafs)
+        return entry
+
+    def get(self, file: Path) -> Entry:
+        file = file.resolve()
+        stat = file_stat(file)
+        entry = self.files.get(file)
+        if entry is None or entry.stat != stat:
+            entry = self._load(file, stat)
+        return entry
+
+    def watch(self, inp: Path) -> None:
+        if inp.is_dir():
+            self.dirs.add(inp.resolve())
+
+    def _try(self, file: Path, load: Callable[[], object]) -> bool:
+        # errors are logged once per file version, the file is tried again
+        # on the next refresh
+        try:
+            load()
+        except (OSError, ValueError, KeyError, AssertionError) as exc:
+            try:
+                stat: tuple[int, int] | None = file_stat(file)
+            except OSError:
+                stat = None
+            err = f"{type(exc).__name__}: {exc}"
+            if self.failed.get(file) != (stat, err):
+                print(f"{file}: {err}", file=sys.stderr)
+            self.failed[file] = (stat, err)
+            return False
+        self.failed.pop(file, None)
+        return True
+
+    def refresh(self) -> int:
+        # reload changed files, forget deleted ones, load new ones
+        changed = 0
+        for file, entry in list(self.files.items()):
+            try:
+                stat = file_stat(file)
+            except FileNotFoundError:
+                del self.files[file]
+                changed += 1
+                continue
+            if stat != entry.stat:
+                changed += self._try(file, lambda: self._load(file, stat))
+        for d in self.dirs:
+            skipped: dict[Path, Path] = {}
+            try:
+                files = label_fmt.input_files(str(d), skipped)
+            except OSError as exc:
+                print(f"{d}: {exc}", file=sys.stderr)
+                continue
+            old = self.skipped.get(d, {})
+            label_fmt.warn_skipped({file: keep for file, keep in skipped.items()
+                                    if old.get(file) != keep})
+            self.skipped[d] = skipped
+            for file in files:
+                if file.resolve() not in self.files:
+                    changed += self._try(file.resolve(), lambda: self.get(file))
+        return changed
+
+    def query(self, args: list[str], cwd: str) -> str:
+        opts = label_fmt.parse_args(args)
+        for name in label_fmt.PATH_OPTS:
+            if getattr(opts, name) is not None:
+                setattr(opts, name, str(Path(cwd, getattr(opts, name))))
+        inp = Path(opts.input)
+        skipped: dict[Path, Path] = {}
+        files = label_fmt.input_files(str(inp), skipped)
+        # to the client, like label_fmt.py
+        label_fmt.warn_skipped(skipped)
+        self.watch(inp)
+        if opts.debug:
+            # rare, straight from the files
+            return json.dumps(dict(label_fmt.LazyData(files)), indent=2) + '\n'
+        entries = [self.get(file) for file in files]
+
+        match = label_fmt.compile_filters(opts.filter or [])
+        items = ((path, leaf) for e in entries for key, path, leaf in e.leafs if match(key))
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            label_fmt.render(opts, items)
+        return out.getvalue()
+
+    def handle(self, req: dict) -> dict:
+        err = io.StringIO()
+        status = 0
+        out = ''
+        with contextlib.redirect_stderr(err):
+            try:
+                out = self.query(req['args'], req.get('cwd', '.'))
+            except SystemExit as exc:
+                # argparse errors and --help
+                status = exc.code if isinstance(exc.code, int) else 2
+            except (OSError, ValueError, KeyError, AssertionError) as exc:
+                print(f"{type(exc).__name__}: {exc}", file=sys.stderr)
+                status = 1
+        return {'out': out, 'err': err.getvalue(), 'status': status}
+
+async def serve(corpus: Corpus, sock_path: str, poll: float) -> None:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            t0 = time.perf_counter()
+            req = json.loads(await reader.readline())
+            res = corpus.handle(req)
+            writer.write(json.dumps(res).encode() + b'\n')
+            await writer.drain()
+            print(f"{' '.join(req['args'])!r}: {len(res['out'])} bytes, "
+                  f"{(time.perf_counter() - t0) * 1000:.1f}ms", file=sys.stderr)
+        except (ValueError, KeyError, ConnectionError) as exc:
+            print(f"bad request: {exc!r}", file=sys.stderr)
+        finally:
+            writer.close()
+
+    async def watch():
+        while True:
+            await asyncio.sleep(poll)
+            try:
+                changed = corpus.refresh()
+            except Exception as exc:
+                # keep watching whatever went wrong
+                print(f"refresh failed: {exc!r}", file=sys.stderr)
+                continue
+            if changed:
+                print(f"{changed} files changed", file=sys.stderr)
+
+    sock = Path(sock_path)
+    sock.parent.mkdir(parents=True, exist_ok=True)
+    sock.unlink(missing_ok=True)
+    server = await asyncio.start_unix_server(handle, path=sock_path)
+    watcher = asyncio.create_task(watch())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+        sock.unlink(missing_ok=True)
+
+def main(opts):
+    corpus = Corpus()
+    t0 = time.perf_counter()
+    for inp in opts.input or ['parsed2']:
+        corpus.watch(Path(inp))
+    corpus.refresh()
+    print(f"{len(corpus.files)} files loaded in {(time.perf_counter() - t0) * 1000:.0f}ms, "
+          f"listening on {opts.socket}", file=sys.stderr)
+    # so the socket gets removed on a plain `kill` too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve(corpus, opts.socket, opts.poll))
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
@@ -1,8 +1,12 @@
 import argparse
+import itertools
 import json
+import os
 import re
+import sys
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Iterable, Iterator, Mapping
 
 def parse_args(args):
     parser = argparse.ArgumentParser("display message/chunk labels in a nicer way")
@@ -22,20 +26,99 @@ def parse_args(args):
                         help="Output ints, not hex")
     parser.add_argument('--table', action='store_true',
                         help="Align columns")
+    parser.add_argument('--index', type=str, nargs='?', const='.cache/label_index.json',
+                        help="use (and update) a persistent leaf index")
+    parser.add_argument('--hex-index', type=str,
+                        help="directory with `human.py --hex --index` files (ID.idx.json), "
+                             "shows where each leaf is in the hex dump")
+    parser.add_argument('--sample', type=int, default=1000,
+                        help="rows used for the column widths (0 = all)")
     return parser.parse_args(args)
 
-def load_data(inp: str):
-    data = {}
+# the options above that are paths, label_daemon.py takes them relative to
+# the client's cwd
+PATH_OPTS = ('input', 'index', 'hex_index')
+
+# chunked json (msg_parser.py), or just the frames (`msg_parser.py --format
+# ndjson|frames`) which are chunked here, only as far as a query needs
+SUFFIXES = ('.json', '.ndjson', '.frames')
+
+def file_id(file: Path) -> str:
+    return file.name.rsplit('.', 1)[0].replace('.', ':')
+
+def input_files(inp: str, skipped: dict[Path, Path] | None = None) -> list[Path]:
     if Path(inp).is_dir():
-        for file in sorted(Path(inp).glob('*.json')):
-            id = file.name[:-5].replace('.', ':')
-            data[id] = json.loads(file.read_bytes())
+        files = sorted(file for file in Path(inp).iterdir() if file.suffix in SUFFIXES)
+        # a capture both as chunked json and as frames: only the newer one
+        # counts, every leaf would be there twice otherwise; the others go
+        # to `skipped` (ignored file -> file used)
+        by_id: dict[str, list[Path]] = {}
+        for file in files:
+            if file.suffix != '.ndjson':
+                by_id.setdefault(file_id(file), []).append(file)
+        skip: dict[Path, Path] = {}
+        for dups in by_id.values():
+            if len(dups) > 1:
+                keep = max(dups, key=lambda file: file.stat().st_mtime_ns)
+                skip.update((file, keep) for file in dups if file != keep)
+        if skipped is not None:
+            skipped.update(skip)
+        return [file for file in files if file not in skip]
+    assert Path(inp).suffix in SUFFIXES, f"{inp}: not one of {', '.join(SUFFIXES)}"
+    return [Path(inp)]
+
+def warn_skipped(skipped: dict[Path, Path]) -> None:
+    for file, keep in skipped.items():
+        print(f"{file_id(file)}: using {keep.name}, ignoring {file.name}", file=sys.stderr)
+
+def iter_transactions(file: Path) -> Iterator[tuple]:
+    # (id, msg_parser.Transaction) of a frame file, imported only when needed
+    import frames
+    import msg_parser
+    if file.suffix == '.ndjson':
+        for id, fs in frames.iter_lines(file):
+            yield id, msg_parser.Transaction.from_frames(fs)
     else:
-        assert inp.endswith('.json')
-        file = Path(inp)
-        id = file.name[:-5].replace('.', ':')
-        data[id] = json.loads(file.read_bytes())
-    return data
+        yield file_id(file), msg_parser.Transaction.from_frames(frames.load(file))
+
+class LazyData(Mapping):
+    # id -> chunked json, read (and chunked) when first accessed; ndjson
+    # lines are kept as they are until then
+    def __init__(self, files: list[Path]):
+        self._src: dict[str, Path | bytes] = {}
+        for file in files:
+            if file.suffix == '.ndjson':
+                with open(file, 'rb') as fp:
+                    for line in fp:
+                        if line.strip():
+                            self._src[json.loads(line)['id']] = line
+            else:
+                self._src[file_id(file)] = file
+        self._data: dict[str, dict] = {}
+
+    def __getitem__(self, id: str) -> dict:
+        if id not in self._data:
+            import frames
+            import msg_parser
+            src = self._src[id]
+            if isinstance(src, bytes):
+                fs = frames.loads_line(src)[1]
+            elif src.suffix == '.frames':
+                fs = frames.load(src)
+            else:
+                self._data[id] = json.loads(src.read_bytes())
+                return self._data[id]
+            self._data[id] = msg_parser.Transaction.from_frames(fs).to_json()
+        return self._data[id]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._src)
+
+    def __len__(self) -> int:
+        return len(self._src)
+
+def load_data(inp: str) -> Mapping[str, dict]:
+    return LazyData(input_files(inp))
 
 iter_exc = ('io', 'raw', 'label')
 def iter_leafs(data: dict, level: int, cb: Callable, path: list[str] = []):
@@ -52,109 +135,278 @@ def iter_leafs(data: dict, level: int, cb: Callable, path: list[str] = []):
     else:
         cb(path, data)
 
+def file_leafs(file: Path, match: Callable[[tuple], bool] | None = None
+               ) -> Iterator[tuple[list[str], dict]]:
+    # (path, leaf) of one file, only those matching; for frame files only
+    # the matching leaves are built
+    if file.suffix == '.json':
+        leafs: list[tuple[list[str], dict]] = []
+        iter_leafs({file_id(file): json.loads(file.read_bytes())}, level=0,
+                   cb=lambda path, leaf: leafs.append((path, leaf)))
+        yield from (item for item in leafs if match is None or match(leaf_key(item[0])))
+        return
+    for id, trans in iter_transactions(file):
+        for path, chunk in trans.iter_chunks():
+            path = [id, *path]
+            if match is None or match(leaf_key(path)):
+                yield path, chunk.to_json()
+
+def file_keys(file: Path) -> list[tuple]:
+    keys: list[tuple] = []
+
+    def collect(key):
+        keys.append(key)
+        return False
+    for _ in file_leafs(file, collect):
+        pass
+    return keys
+
+def walk_files(files: list[Path], match: Callable[[tuple], bool] | None = None
+               ) -> Iterator[tuple[list[str], dict]]:
+    # the leafs of one file after the other, only one file is loaded at a time
+    for file in files:
+        yield from file_leafs(file, match)
+
+# position of the filter keys in a (id, msg, io, bpid, label) key
+KEY_POS = {'id': 0, 'msg': 1, 'io': 2, 'label': 4}
+
+def leaf_key(path: list[str]) -> tuple:
+    if len(path) == 4:
+        id, msg, io, label = path
+        return id, msg, io, None, label
+    return tuple(path)
+
+@dataclass(frozen=True)
+class Filter():
+    key: str
+    values: frozenset[str]
+    regex: re.Pattern | None = None
+
+    @classmethod
+    def parse(cls, filter: str) -> 'Filter':
+        k, mss = filter.split('=', 1)
+        ms = mss.split(',')
+        regex = re.compile(ms[0].replace('*', '.*')) if k == 'path' else None
+        return cls(key=k, values=frozenset(ms), regex=regex)
+
+    def __call__(self, key: tuple) -> bool:
+        pos = KEY_POS.get(self.key)
+        if pos is not None:
+            return key[pos] in self.values
+        if self.regex is not None:
+            return self.regex.match('.'.join(k for k in key if k is not None)) is not None
+        # unknown keys don't filter anything
+        return True
+
+def compile_filters(filters: list[str]) -> Callable[[tuple], bool]:
+    fs = [Filter.parse(f) for f in filters]
+    if not fs:
+        return lambda key: True
+    return lambda key: all(f(key) for f in fs)
+
+def iter_rows(items: Iterable[tuple[list[str], dict]], addr: bool = False,
+              line: int | None = None, ints: bool = False,
+              locate: Callable[[list[str], dict], str] | None = None) -> Iterator[list[str]]:
+    # one table row per leaf, or per `line` path prefix
+    row: list[str] | None = None
+    last_match = None
+    for path, data in items:
+        d_raw = [data['raw']] if not ints else list(map(str, data['int']))
+        if locate is not None:
+            d_raw.insert(0, locate(path, data))
+        if line is None:
+            if addr:
+                addr_s = f"{data['start']:0>2x}:{data['start'] + data['sz']:0>2x}"
+                yield ['.'.join(path), addr_s, *d_raw]
+            else:
+                yield ['.'.join(path), *d_raw]
+            continue
+
+        addr_s = f" {data['start']:0>2x}:{data['start'] + data['sz']:0>2x}" if addr else ''
+        match = '.'.join(path[:line])
+        if row is not None and match == last_match:
+            if addr_s:
+                row.append(addr_s)
+            row.extend(d_raw)
+        else:
+            if row is not None:
+                yield row
+            last_match = match
+            row = [match, addr_s, *d_raw] if addr_s else [match, *d_raw]
+    if row is not None:
+        yield row
+
+class Table():
+    # Prints rows as they come. Column widths are taken from the first
+    # `sample` rows (0 = all rows, which buffers the whole table) and only
+    # grow afterwards, so a wider late row shifts the columns after it.
+    def __init__(self, pad: bool = True, pad_dirs: str = '<', sample: int = 1000):
+        self.pad = pad
+        self.pad_dirs = pad_dirs
+        self.sample = sample
+        self.widths: list[int] = []
+        # for summary(): row count and the distinct values of every column
+        self.rows = 0
+        self.uniq: list[set[str]] = []
+
+    def _add(self, row: list[str]) -> None:
+        self.rows += 1
+        for i, item in enumerate(row):
+            if i == len(self.widths):
+                self.widths.append(0)
+                self.uniq.append(set())
+            self.widths[i] = max(self.widths[i], len(item))
+            if i:
+                self.uniq[i].add(item)
+
+    def _print(self, row: list[str]) -> None:
+        res_line = []
+        for i, item in enumerate(row):
+            padding = ' ' * (self.widths[i] - len(item)) if self.pad else ''
+            pad_dir = self.pad_dirs[i] if i < len(self.pad_dirs) else self.pad_dirs[-1]
+            res_line.append((padding + item) if pad_dir == '>' else (item + padding))
+        print(' '.join(res_line))
+
+    def render(self, rows: Iterable[list[str]]) -> None:
+        rows = iter(rows)
+        head = list(itertools.islice(rows, self.sample)) if self.sample else list(rows)
+        for row in head:
+            self._add(row)
+        for row in head:
+            self._print(row)
+        del head
+        for row in rows:
+            self._add(row)
+            self._print(row)
+
+    def summary(self) -> None:
+        items = [f'{self.rows}', *(f'{len(uniq)}' for uniq in self.uniq[1:])]
+        line = []
+        for i, item in enumerate(items):
+            width = self.widths[i] if i < len(self.widths) else 0
+            padding = ' ' * (width - len(item)) if self.pad else ''
+            line.append(padding + item)
+        print(' '.join(line))
+
 class Observer():
+    # collects matching leaves, for use as an iter_leafs callback
     def __init__(self, filters: list[str]):
         self.filters = filters
+        self.match = compile_filters(filters)
         self._items: list[tuple[list[str], dict]] = []
 
     def __call__(self, path: list[str], leaf: dict):
-        bpid = None
-        if len(path) == 4:
-            id, msg, io, label = path
-        else:
-            id, msg, io, bpid, label = path
-
-        for filter in self.filters:
-            k, mss = filter.split('=', 1)
-            ms = mss.split(',')
-            if k == 'id' and id not in ms:
-                return
-            if k == 'io' and io not in ms:
-                return
-            if k == 'msg' and msg not in ms:
-                return
-            if k == 'label' and label not in ms:
-                return
-            if k == 'path' and not re.match(ms[0].replace('*', '.*'), '.'.join(path)):
-                return
-        self._items.append((path, leaf))
-        # print(f'{".".join(path)}  {leaf["raw"]}')
+        if self.match(leaf_key(path)):
+            self._items.append((path, leaf))
+
+    def extend(self, items: Iterable[tuple[list[str], dict]]):
+        # already filtered, e.g. by Index.query
+        self._items.extend(items)
 
     def show(self, pad: bool = True, pad_dirs: str = '<', addr: bool = False, line: int | None = None, ints: bool = False):
-        tdata = []
-        if line is None:
-            for path, data in self._items:
-                jpath = '.'.join(path)
-                d_raw = [data['raw']] if not ints else list(map(str, data['int']))
-                if addr:
-                    addr_s = f"{data['start']:0>2x}:{data['start'] + data['sz']:0>2x}"
-                    items = [jpath, addr_s, *d_raw]
-                else:
-                    items = [jpath, *d_raw]
-                tdata.append(items)
-        else:
-            last_match = None
-            for path, data in self._items:
-                jpath = '.'.join(path)
-                d_raw = [data['raw']] if not ints else list(map(str, data['int']))
-                addr_s = f" {data['start']:0>2x}:{data['start'] + data['sz']:0>2x}" if addr else ''
-
-                match = '.'.join(path[:line])
-                if match == last_match:
-                    if addr_s:
-                        tdata[-1].append(addr_s)
-                    tdata[-1].extend(d_raw)
-                else:
-                    last_match = match
-                    if addr_s:
-                        tdata.append([match, addr_s, *d_raw])
-                    else:
-                        tdata.append([match, *d_raw])
-        max_col_w = [0] * (max(len(tdata_line) for tdata_line in tdata)
-                           if tdata
-                           else 1)
-        for tdata_line in tdata:
-            for i, item in enumerate(tdata_line):
-                max_col_w[i] = max(max_col_w[i], len(item))
-
-        for i, tdata_line in enumerate(tdata):
-            res_line = []
-            for i, item in enumerate(tdata_line):
-                padding = ' ' * (max_col_w[i] - len(item)) if pad else ''
-                pad_dir = pad_dirs[i] if i < len(pad_dirs) else pad_dirs[-1]
-                res_line.append((padding + item) if pad_dir == '>' else (item + padding))
-            print(' '.join(res_line))
-
-        self._tdata = tdata
-        self._max_col_w = max_col_w
+        self._table = Table(pad=pad, pad_dirs=pad_dirs, sample=0)
+        self._table.render(iter_rows(self._items, addr=addr, line=line, ints=ints))
 
     def summary(self, pad: bool = True):
-        tdata = self._tdata
-        max_col_w = self._max_col_w
-        items = [f'{len(self._tdata)}']
-        for col in range(1, len(max_col_w)):
-            uniq = len(set(tdata[i][col] for i in range(len(tdata))
-                           if col < len(tdata[i])))
-            items.append(f'{uniq}')
+        self._table.pad = pad
+        self._table.summary()
 
-        line = []
-        for i, item in enumerate(items):
-            padding = ' ' * (max_col_w[i] - len(item)) if pad else ''
-            line.append(padding + item)
-        print(' '.join(line))
+class Index():
+    # Leaf keys of every parsed2 file, so a query only loads the files
+    # holding matching leaves and picks those leaves out directly. Files
+    # are re-indexed when their size/mtime changes.
+    VERSION = 2
 
-def main(opts):
-    data = load_data(opts.input)
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        # resolved file name -> {'stat': [size, mtime_ns], 'keys': [leaf_key...]}
+        self.files: dict[str, dict] = {}
+        self.dirty = False
+        if self.path.exists():
+            data = json.loads(self.path.read_bytes())
+            if data.get('version') == self.VERSION:
+                self.files = data['files']
+
+    def update(self, files: list[Path]) -> None:
+        for file in files:
+            st = file.stat()
+            stat = [st.st_size, st.st_mtime_ns]
+            name = str(file.resolve())
+            entry = self.files.get(name)
+            if entry is not None and entry['stat'] == stat:
+                continue
+            self.files[name] = {'stat': stat, 'keys': [list(key) for key in file_keys(file)]}
+            self.dirty = True
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(json.dumps({'version': self.VERSION, 'files': self.files}))
+        os.replace(tmp, self.path)
+        self.dirty = False
 
+    def query(self, files: list[Path],
+              match: Callable[[tuple], bool]) -> Iterator[tuple[list[str], dict]]:
+        for file in files:
+            hits = [key for key in map(tuple, self.files[str(file.resolve())]['keys'])
+                    if match(key)]
+            if not hits:
+                continue
+            if file.suffix != '.json':
+                yield from file_leafs(file, match)
+                continue
+            data = json.loads(file.read_bytes())
+            for key in hits:
+                _, msg, io, bpid, label = key
+                node = data[msg][io]
+                if bpid is not None:
+                    node = node['items'][int(bpid)]
+                yield [k for k in key if k is not None], node[label]
+
+def main(opts):
+    match = compile_filters(opts.filter or [])
+    skipped: dict[Path, Path] = {}
+    files = input_files(opts.input, skipped)
+    warn_skipped(skipped)
     if opts.debug:
-        print(json.dumps(data, indent=2))
+        print(json.dumps(dict(load_data(opts.input)), indent=2))
         return
-    obs = Observer(opts.filter or [])
-    iter_leafs(data, level=0, cb=obs)
-    obs.show(pad=opts.table, addr=opts.addr, line=opts.line, ints=opts.int)
+    if opts.index:
+        index = Index(opts.index)
+        index.update(files)
+        index.save()
+        items = index.query(files, match)
+    else:
+        items = walk_files(files, match)
+    render(opts, items)
+
+def hex_locator(inp: str) -> Callable[[list[str], dict], str]:
+    # '@offset' of a leaf in the `human.py --hex` dump of its capture, from
+    # the INP/<id>.idx.json written by `human.py --hex --index`
+    import human
+    indexes: dict[str, human.HexIndex | None] = {}
+
+    def locate(path: list[str], leaf: dict) -> str:
+        id = path[0]
+        if id not in indexes:
+            file = Path(inp) / f"{id.replace(':', '.')}.idx.json"
+            indexes[id] = human.HexIndex.load(file) if file.exists() else None
+        index = indexes[id]
+        try:
+            return f"@{index.offset(path, leaf['start']):0>6x}" if index else '-'
+        except (KeyError, StopIteration):
+            return '-'
+    return locate
+
+def render(opts, items: Iterable[tuple[list[str], dict]]) -> None:
+    locate = hex_locator(opts.hex_index) if opts.hex_index else None
+    table = Table(pad=opts.table, sample=opts.sample)
+    table.render(iter_rows(items, addr=opts.addr, line=opts.line, ints=opts.int,
+                           locate=locate))
     if opts.summary:
-        obs.summary()
+        table.summary()
 
 if __name__ == '__main__':
-    import sys
     main(parse_args(sys.argv[1:]))
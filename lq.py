@@ -0,0 +1,28 @@
+import json
+import os
+import socket
+import sys
+
+# Thin client for label_daemon.py, takes the same arguments as label_fmt.py.
+# Deliberately imports nothing else so startup stays short.
+
+SOCKET = os.environ.get('LABEL_FMT_SOCKET', '.cache/label_fmt.sock')
+
+def query(args: list[str], sock_path: str = SOCKET) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(sock_path)
+        s.sendall(json.dumps({'args': args, 'cwd': os.getcwd()}).encode() + b'\n')
+        buf = []
+        while chunk := s.recv(1 << 16):
+            buf.append(chunk)
+    return json.loads(b''.join(buf))
+
+if __name__ == '__main__':
+    try:
+        res = query(sys.argv[1:])
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"no label_daemon.py listening on {SOCKET}", file=sys.stderr)
+        sys.exit(2)
+    sys.stdout.write(res['out'])
+    sys.stderr.write(res['err'])
+    sys.exit(res['status'])
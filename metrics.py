@@ -0,0 +1,113 @@
+import json
+import time
+from dataclasses import dataclass, field, asdict
+from typing import TextIO
+
+# Per message timings of an Exchange: one event per request/response (or
+# failed attempt), exportable as json lines, plus per label aggregates.
+# Exchange only calls in here when it has a Metrics, so leaving it out
+# costs a single `is None` check per message.
+
+@dataclass
+class Event:
+    # seconds since the Metrics was created
+    t: float
+    label: str
+    # get_req -> set_res (or res_failed)
+    dt: float
+    req_bytes: int
+    res_bytes: int
+    # intact BP records in the response
+    records: int = 0
+    ok: bool = True
+
+class Histogram:
+    # log2 buckets, bucket i counts values in [2**(i-1), 2**i) of `unit`,
+    # bucket 0 everything below one unit
+    def __init__(self, unit: float = 1e-3):
+        self.unit = unit
+        self.buckets: list[int] = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        i = int(value / self.unit).bit_length()
+        if i >= len(self.buckets):
+            self.buckets.extend([0] * (i + 1 - len(self.buckets)))
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-quantile
+        want = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= want:
+                return min((1 << i) * self.unit, self.max)
+        return self.max
+
+    def to_json(self) -> dict:
+        return {'unit': self.unit, 'buckets': self.buckets, 'count': self.count,
+                'total': self.total, 'max': self.max}
+
+@dataclass
+class LabelStats:
+    latency: Histogram = field(default_factory=Histogram)
+    req_bytes: int = 0
+    res_bytes: int = 0
+    records: int = 0
+    retries: int = 0
+
+@dataclass
+class Metrics:
+    # can be shared by several exchanges (e.g. a whole Scheduler run)
+    keep_events: bool = True
+    events: list[Event] = field(default_factory=list)
+    labels: dict[str, LabelStats] = field(default_factory=dict)
+    t0: float = field(default_factory=time.perf_counter)
+
+    def record(self, label: str, t_req: float, req_bytes: int, res_bytes: int = 0,
+               records: int = 0, ok: bool = True) -> None:
+        now = time.perf_counter()
+        stats = self.labels.get(label)
+        if stats is None:
+            stats = self.labels[label] = LabelStats()
+        stats.req_bytes += req_bytes
+        if ok:
+            stats.latency.add(now - t_req)
+            stats.res_bytes += res_bytes
+            stats.records += records
+        else:
+            stats.retries += 1
+        if self.keep_events:
+            self.events.append(Event(t=t_req - self.t0, label=label, dt=now - t_req,
+                                     req_bytes=req_bytes, res_bytes=res_bytes,
+                                     records=records, ok=ok))
+
+    def write_jsonl(self, fp: TextIO) -> None:
+        for ev in self.events:
+            fp.write(json.dumps(asdict(ev)) + '\n')
+
+    def to_json(self) -> dict:
+        return {label: {'latency': s.latency.to_json(), 'req_bytes': s.req_bytes,
+                        'res_bytes': s.res_bytes, 'records': s.records,
+                        'retries': s.retries}
+                for label, s in self.labels.items()}
+
+    def summary(self) -> str:
+        lines = [f"{'label':<6} {'n':>6} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8} "
+                 f"{'max ms':>8} {'retry':>6} {'out B':>8} {'in B':>8} {'recs':>6}"]
+        for label, s in self.labels.items():
+            h = s.latency
+            lines.append(f"{label:<6} {h.count:>6} {h.mean() * 1000:>9.2f} "
+                         f"{h.quantile(0.5) * 1000:>8.2f} {h.quantile(0.99) * 1000:>8.2f} "
+                         f"{h.max * 1000:>8.2f} {s.retries:>6} {s.req_bytes:>8} "
+                         f"{s.res_bytes:>8} {s.records:>6}")
+        return '\n'.join(lines)
@@ -1,11 +1,15 @@
 from dataclasses import dataclass, field
-from typing import Literal, Callable
+from typing import Literal, ClassVar, Callable, Iterable, Iterator
 from tools import ints, add_checksum, to_bytes, pretty_hex, s_checksum, split_i
 import datetime
 
 def b(s): return bytes.fromhex(s.replace(':', ''))
 
 io_t = Literal['in', 'out', 'other']
+# one BP record in a memory read response
+BP_ITEM_LEN = 0x0e
+# messages may be views into a bigger buffer (e.g. BP items in a BP response)
+buf_t = bytes | memoryview
 
 def enc_ts(ts: datetime.datetime) -> bytes:
     return bytes([
@@ -27,25 +31,35 @@ def dec_ts(bts: bytes) -> datetime.datetime:
 class Chunk():
     start: int
     sz: int
-    raw: bytes
+    # the whole message, shared between all chunks of it
+    buf: buf_t
     label: str
 
     @property
     def end(self): return self.start + self.sz
 
+    @property
+    def view(self) -> memoryview:
+        return memoryview(self.buf)[self.start:self.end]
+
+    @property
+    def raw(self) -> bytes:
+        return bytes(self.view)
+
     @classmethod
-    def builder(cls, raw: bytes):
+    def builder(cls, raw: buf_t):
         def init(start: int, sz: int, label: str):
             return cls(start=start,
                        sz=sz,
-                       raw=raw[start:start+sz],
+                       buf=raw,
                        label=label)
         return init
 
     def to_json(self, short: bool = False):
+        view = self.view
         return {
-            'raw': pretty_hex(self.raw),
-            'int': list(self.raw),
+            'raw': pretty_hex(view),
+            'int': view.tolist(),
             **({
                 'start': self.start,
                 'sz': self.sz,
@@ -54,24 +68,74 @@ class Chunk():
         }
 
     def to_i(self):
-        res = 0
-        for b in self.raw:
-            res *= 256
-            res += b
-        return res
+        if self.sz == 1:
+            return self.buf[self.start]
+        return int.from_bytes(self.view, 'big')
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, frozen=True)
 class ProtoChunk():
     start: int | None = None
     sz: int
     label: str
 
+# (start, sz, label), sorted by start, const gaps included
+field_t = tuple[int, int, str]
+
+@dataclass(kw_only=True)
+class Layout():
+    chunks: tuple[ProtoChunk, ...] = ()
+    # compiled fields + label index, per (message length, complete)
+    _compiled: dict[tuple[int, bool], tuple[list[field_t], dict[str, int]]] = \
+        field(default_factory=dict, repr=False)
+
+    def compile(self, length: int, complete: bool = False):
+        key = (length, complete)
+        res = self._compiled.get(key)
+        if res is None:
+            res = self._compiled[key] = self._compile(length, complete)
+        return res
+
+    def _compile(self, length: int, complete: bool):
+        fields: list[field_t] = []
+        last_end = 0
+        if not complete:
+            fields.append((0, 1, '$msg_size'))
+            fields.append((1, 1, '$msg_io'))
+            last_end = 2
+        for pchunk in self.chunks:
+            start = pchunk.start if pchunk.start is not None else last_end
+            fields.append((start, pchunk.sz, pchunk.label))
+            last_end = start + pchunk.sz
+        if not complete:
+            fields.append((length - 1, 1, '$msg_cs'))
+        fields.sort(key=lambda f: f[0])
+
+        const_id = 0
+        start = 0
+        consts: list[field_t] = []
+        for f_start, f_sz, _ in fields:
+            if start < f_start:
+                consts.append((start, f_start - start, f'$c:{const_id:0>2}'))
+                const_id += 1
+            start = f_start + f_sz
+        fields.extend(consts)
+        fields.sort(key=lambda f: f[0])
+
+        index: dict[str, int] = {}
+        for i, (_, _, label) in enumerate(fields):
+            index.setdefault(label, i)
+        return fields, index
+
+EMPTY_LAYOUT = Layout()
+
 @dataclass(kw_only=True)
 class Message():
     io: io_t
-    raw: bytes
+    raw: buf_t
     chunks: list[Chunk] = field(default_factory=list)
     label: str
+    # label -> position in chunks
+    index: dict[str, int] = field(default_factory=dict, repr=False, compare=False)
 
     def to_json(self):
         return {
@@ -82,65 +146,24 @@ class Message():
         }
 
     def get_chunk(self, label: str) -> Chunk | None:
-        for chunk in self.chunks:
-            if chunk.label == label:
-                return chunk
-        return None
+        i = self.index.get(label)
+        return self.chunks[i] if i is not None else None
+
+    def __getitem__(self, label: str) -> Chunk:
+        return self.chunks[self.index[label]]
 
     @classmethod
-    def build(cls, raw: bytes, chunks: list[ProtoChunk] = [], label: str | None = None, io: io_t | None = None, complete: bool = False):
-        cbuild = Chunk.builder(raw)
-        rchunks: list[Chunk] = []
-        last_end = 0
-        if not complete:
-            rchunks.append(cbuild(
-                start=0,
-                sz=1,
-                label='$msg_size',
-            ))
-            rchunks.append(cbuild(
-                start=1,
-                sz=1,
-                label='$msg_io',
-            ))
-            last_end = 2
-        for i, pchunk in enumerate(chunks):
-            rchunks.append(cbuild(
-                start=pchunk.start if pchunk.start is not None else last_end,
-                sz=pchunk.sz,
-                label=pchunk.label))
-            last_end = rchunks[-1].end
-        if not complete:
-            rchunks.append(cbuild(
-                start=len(raw) - 1,
-                sz=1,
-                label='$msg_cs',
-            ))
-        rchunks.sort(key=lambda ch: ch.start)
-        cls.add_const(rchunks, cbuild)
+    def build(cls, raw: buf_t, chunks: Layout | list[ProtoChunk] = EMPTY_LAYOUT, label: str | None = None, io: io_t | None = None, complete: bool = False):
+        layout = chunks if isinstance(chunks, Layout) else Layout(chunks=tuple(chunks))
+        fields, index = layout.compile(len(raw), complete)
         return cls(raw=raw,
-                   chunks=rchunks,
+                   chunks=[Chunk(start=start, sz=sz, buf=raw, label=label)
+                           for start, sz, label in fields],
+                   index=index,
                    **({'label': label} if label is not None else {}),  # type: ignore[arg-type]
                    **({'io': io} if io is not None else {}),  # type: ignore[arg-type]
                    )
 
-    @classmethod
-    def add_const(cls, rchunks: list[Chunk], cbuild: Callable):
-        const_id = 0
-        start = 0
-        cchunks: list[Chunk] = []
-        for chunk in rchunks:
-            if start < chunk.start:
-                cchunks.append(cbuild(
-                    start=start,
-                    sz=chunk.start-start,
-                    label=f'$c:{const_id:0>2}',
-                ))
-                const_id += 1
-            start = chunk.end
-        rchunks.extend(cchunks)
-        rchunks.sort(key=lambda ch: ch.start)
-
     @classmethod
     def make_req(cls, label: str,
                  payload: bytes):
@@ -158,36 +181,53 @@ class Message():
 class MessageResM0(Message):
     io: io_t = 'out'
     label: str = 'M0'
+    LAYOUT: ClassVar[Layout] = Layout(chunks=(
+        ProtoChunk(start=0x08, sz=1, label='fl1'),
+        ProtoChunk(start=0x09, sz=1, label='last'),
+        ProtoChunk(start=0x0c, sz=1, label='fl2'),
+        ProtoChunk(start=0x0d, sz=1, label='pend'),
+        ProtoChunk(start=0x13, sz=1, label='last2'),
+        ProtoChunk(start=0x14, sz=1, label='fl3'),
+        ProtoChunk(start=0x29, sz=1, label='it'),
+        ProtoChunk(start=0x30, sz=2, label='cs'),
+    ))
 
     @classmethod
     def from_bytes(cls, raw: bytes):
-        return cls.build(
-            io=cls.io,
-            raw=raw, chunks=[
-                ProtoChunk(start=0x08, sz=1, label='fl1'),
-                ProtoChunk(start=0x09, sz=1, label='last'),
-                ProtoChunk(start=0x0c, sz=1, label='fl2'),
-                ProtoChunk(start=0x0d, sz=1, label='pend'),
-                ProtoChunk(start=0x13, sz=1, label='last2'),
-                ProtoChunk(start=0x14, sz=1, label='fl3'),
-                ProtoChunk(start=0x29, sz=1, label='it'),
-                ProtoChunk(start=0x30, sz=2, label='cs'),
-            ])
+        return cls.build(io=cls.io, raw=raw, chunks=cls.LAYOUT)
 
 @dataclass(kw_only=True)
 class MessageResM1(Message):
     io: io_t = 'out'
     label: str = 'M1'
+    LAYOUT: ClassVar[Layout] = Layout(chunks=(
+        ProtoChunk(start=0x0e, sz=6, label='ts'),
+        ProtoChunk(start=0x14, sz=1, label='x'),
+        ProtoChunk(start=0x15, sz=1, label='cs'),
+    ))
 
     @classmethod
     def from_bytes(cls, raw: bytes):
-        return cls.build(
-            io=cls.io,
-            raw=raw, chunks=[
-                ProtoChunk(start=0x0e, sz=6, label='ts'),
-                ProtoChunk(start=0x14, sz=1, label='x'),
-                ProtoChunk(start=0x15, sz=1, label='cs'),
-            ])
+        return cls.build(io=cls.io, raw=raw, chunks=cls.LAYOUT)
+
+def bp_record_ok(rec: buf_t) -> bool:
+    # b[13] = sum(b[0:12]) % 256, b[12] = 255 - b[13]
+    return s_checksum(rec[:12]) == rec[13] and rec[12] == 255 - rec[13]
+
+def bp_intact(recs: Iterable[buf_t]) -> int:
+    # records up to the first one with a bad checksum
+    n = 0
+    for rec in recs:
+        if not bp_record_ok(rec):
+            break
+        n += 1
+    return n
+
+def bp_region(raw: buf_t) -> memoryview:
+    # the whole records in a BP memory read response (6 header bytes, then
+    # raw[5] bytes of records), never past the end of the frame
+    n = min(raw[5], len(raw) - 8) // BP_ITEM_LEN
+    return memoryview(raw)[0x06:0x06 + n * BP_ITEM_LEN]
 
 @dataclass(kw_only=True)
 class MessageBPItem(Message):
@@ -200,22 +240,24 @@ class MessageBPItem(Message):
         pos: int
 
     io: io_t = 'other'
+    LAYOUT: ClassVar[Layout] = Layout(chunks=(
+        ProtoChunk(start=0x00, sz=1, label='dia'),
+        ProtoChunk(start=0x01, sz=1, label='sys'),
+        ProtoChunk(start=0x02, sz=1, label='fl1'),
+        ProtoChunk(start=0x03, sz=1, label='pulse'),
+        ProtoChunk(start=0x04, sz=4, label='ts'),
+        ProtoChunk(start=0x08, sz=1, label='fl2'),
+        ProtoChunk(start=0x0b, sz=1, label='pos'),
+        ProtoChunk(start=0x0c, sz=2, label='cs'),
+    ))
 
     @classmethod
-    def from_bytes(cls, idx: int, raw: bytes):
-        return cls.build(
-            label=f'bp-item:{idx:0>2d}',
-            raw=raw, chunks=[
-                ProtoChunk(start=0x00, sz=1, label='dia'),
-                ProtoChunk(start=0x01, sz=1, label='sys'),
-                ProtoChunk(start=0x02, sz=1, label='fl1'),
-                ProtoChunk(start=0x03, sz=1, label='pulse'),
-                ProtoChunk(start=0x04, sz=4, label='ts'),
-                ProtoChunk(start=0x08, sz=1, label='fl2'),
-                ProtoChunk(start=0x0b, sz=1, label='pos'),
-                ProtoChunk(start=0x0c, sz=2, label='cs'),
-            ],
-            complete=True)
+    def from_bytes(cls, idx: int, raw: buf_t):
+        return cls.build(label=f'bp-item:{idx:0>2d}', raw=raw,
+                         chunks=cls.LAYOUT, complete=True)
+
+    def cs_ok(self) -> bool:
+        return bp_record_ok(self.raw)
 
     def to_human(self):
         # TODO(Iskren): flags!
@@ -252,11 +294,11 @@ class MessageResBP(Message):
 
     @classmethod
     def from_bytes(cls, raw: bytes):
-        sz = raw[5] // 0x0e
+        region = bp_region(raw)
         return cls(
             raw=raw,
-            items=[MessageBPItem.from_bytes(i, raw[0x06+i*0x0e:0x06+(i+1)*0x0e])
-                   for i in range(sz)]
+            items=[MessageBPItem.from_bytes(i, region[j:j + BP_ITEM_LEN])
+                   for i, j in enumerate(range(0, len(region), BP_ITEM_LEN))]
         )
 
 
@@ -268,19 +310,18 @@ class MessageResBP(Message):
 class MessageReqM2(Message):
     io: io_t = 'in'
     label: str = 'M2'
+    LAYOUT: ClassVar[Layout] = Layout(chunks=(
+        ProtoChunk(start=0x05, sz=1, label='ilen'),
+        ProtoChunk(start=0x08, sz=1, label='fl1'),
+        ProtoChunk(start=0x09, sz=1, label='last'),
+        ProtoChunk(start=0x13, sz=1, label='last2'),
+        ProtoChunk(start=0x14, sz=1, label='fl2'),
+    ))
 
     @classmethod
     def from_bytes(cls, raw: bytes):
         assert len(raw) == raw[0x05] + 8
-        return cls.build(
-            raw=raw,
-            chunks=[
-                ProtoChunk(start=0x05, sz=1, label='ilen'),
-                ProtoChunk(start=0x08, sz=1, label='fl1'),
-                ProtoChunk(start=0x09, sz=1, label='last'),
-                ProtoChunk(start=0x13, sz=1, label='last2'),
-                ProtoChunk(start=0x14, sz=1, label='fl2'),
-            ])
+        return cls.build(raw=raw, chunks=cls.LAYOUT)
 
 
     @classmethod
@@ -296,6 +337,18 @@ class MessageReqM2(Message):
 class MessageReqM3(Message):
     io: io_t = 'in'
     label: str = 'M3'
+    LAYOUT_SHORT: ClassVar[Layout] = Layout(chunks=(
+        ProtoChunk(start=0x05, sz=1, label='ilen'),
+        ProtoChunk(start=0x0b, sz=1, label='it'),
+        ProtoChunk(start=0x12, sz=2, label='cs1'),
+    ))
+    # with device time (only sent when measurements were read)
+    LAYOUT_LONG: ClassVar[Layout] = Layout(chunks=(
+        *LAYOUT_SHORT.chunks,
+        ProtoChunk(start=0x1c, sz=6, label='ts'),
+        ProtoChunk(start=0x22, sz=1, label='x'),
+        ProtoChunk(start=0x23, sz=1, label='cs2'),
+    ))
 
     @classmethod
     def from_bytes(cls, raw: bytes):
@@ -305,23 +358,14 @@ class MessageReqM3(Message):
         assert len(raw) == ilen + 8
         return cls.build(
             raw=raw,
-            chunks=[
-                ProtoChunk(start=0x05, sz=1, label='ilen'),
-                ProtoChunk(start=0x0b, sz=1, label='it'),
-                ProtoChunk(start=0x12, sz=2, label='cs1'),
-                *([
-                    ProtoChunk(start=0x1c, sz=6, label='ts'),
-                    ProtoChunk(start=0x22, sz=1, label='x'),
-                    ProtoChunk(start=0x23, sz=1, label='cs2'),
-                ] if ilen == 0x1e else []),
-            ])
+            chunks=cls.LAYOUT_LONG if ilen == 0x1e else cls.LAYOUT_SHORT)
 
 
     @classmethod
     def from_fields(cls, it: int, ts: datetime.datetime | None, x: int | None):
         header = to_bytes('c0:02:c2', 0x1e if ts else 0x0e)
         pc1_a = to_bytes('01:00:00:01:00', it, '00:00:00:00:00:00')
-        pc1 = to_bytes(pc1_a, (257 - sum(pc1_a) % 256) % 256, it + 2)
+        pc1 = to_bytes(pc1_a, (257 - sum(pc1_a) % 256) % 256, (it + 2) % 256)
         if ts is not None and x is not None:
             pc2_a = to_bytes('a0:c0:00:03:00:00:00:00', enc_ts(ts))
             pc2 = to_bytes(pc2_a, x, s_checksum(pc2_a)) if ts else None
@@ -343,6 +387,58 @@ class MessagePair():
             'label': self.label,
         }
 
+
+@dataclass(kw_only=True, frozen=True)
+class MessageKind():
+    label: str
+    build_req: Callable[[bytes], Message]
+    build_res: Callable[[bytes], Message]
+    # response repeats the request (sans io byte and checksum)
+    echo: bool = False
+
+def _generic(io: io_t, label: str) -> Callable[[bytes], Message]:
+    return lambda raw: Message.build(io=io, label=label, raw=raw)
+
+# request bytes [2:2+n] -> kind, looked up longest prefix first
+REQ_PREFIXES: dict[int, dict[bytes, MessageKind]] = {}
+KINDS: dict[str, MessageKind] = {}
+
+def register(kind: MessageKind, *prefixes: bytes) -> MessageKind:
+    KINDS[kind.label] = kind
+    for prefix in prefixes:
+        REQ_PREFIXES.setdefault(len(prefix), {})[prefix] = kind
+    # keep longest prefixes first
+    for n in sorted(REQ_PREFIXES, reverse=True):
+        REQ_PREFIXES[n] = REQ_PREFIXES.pop(n)
+    return kind
+
+def kind_from_req(req: bytes) -> MessageKind | None:
+    for n, table in REQ_PREFIXES.items():
+        kind = table.get(req[2:2+n])
+        if kind is not None:
+            return kind
+    return None
+
+register(MessageKind(label='M0', build_req=_generic('in', 'M0'),
+                     build_res=lambda raw: MessageResM0.from_bytes(raw=raw)),
+         b('00:02:60:2c'))
+register(MessageKind(label='M1', build_req=_generic('in', 'M1'),
+                     build_res=lambda raw: MessageResM1.from_bytes(raw=raw)),
+         b('00:02:8c:10'))
+# memory reads anywhere in the measurement ring 0x08XX - 0x0dXX
+register(MessageKind(label='BP', build_req=_generic('in', 'BP'),
+                     build_res=lambda raw: MessageResBP.from_bytes(raw=raw)),
+         *(bytes([0x00, hi]) for hi in range(0x08, 0x0d + 1)))
+register(MessageKind(label='M2', build_req=lambda raw: MessageReqM2.from_bytes(raw=raw),
+                     build_res=_generic('out', 'M2'), echo=True),
+         b('c0:02:a4:10'))
+register(MessageKind(label='M3', build_req=lambda raw: MessageReqM3.from_bytes(raw=raw),
+                     build_res=_generic('out', 'M3'), echo=True),
+         b('c0:02:c2'))
+register(MessageKind(label='M4', build_req=_generic('in', 'M4'),
+                     build_res=_generic('out', 'M4'), echo=True),
+         b('00:00:00:00'))
+
 @dataclass(kw_only=True)
 class Transaction():
     pairs: list[MessagePair]
@@ -350,93 +446,83 @@ class Transaction():
     def to_json(self):
         return {pair.label: pair.to_json() for pair in self.pairs}
 
+    def iter_chunks(self) -> Iterator[tuple[list[str], Chunk]]:
+        # the leaves of to_json(), in the same order, without building it:
+        # (label, io, [bp item,] chunk label) and the chunk
+        for label, pair in {pair.label: pair for pair in self.pairs}.items():
+            for io, m in (('req', pair.req), ('res', pair.res)):
+                if isinstance(m, MessageResBP):
+                    for i, item in enumerate(m.items):
+                        for chunk in {c.label: c for c in item.chunks}.values():
+                            yield [label, io, f'{i:0>2}', chunk.label], chunk
+                else:
+                    for chunk in {c.label: c for c in m.chunks}.values():
+                        yield [label, io, chunk.label], chunk
+
     @classmethod
     def from_hex_list(cls, hex_list: list[str], merge_bp: bool = True):
+        return cls.from_frames([b(msg) for msg in hex_list], merge_bp=merge_bp)
+
+    @classmethod
+    def from_frames(cls, frames: list[bytes], merge_bp: bool = True):
         pairs: list[MessagePair] = []
-        for req_s, res_s in zip(hex_list[::2], hex_list[1::2]):
-            req_b = b(req_s)
-            res_b = b(res_s)
-            if req_b[2:6] == b('00:02:60:2c'):
-                label = 'M0'
-                pairs.append(MessagePair(
-                    label=label,
-                    req=Message.build(io='in', label=label, raw=req_b),
-                    res=MessageResM0.from_bytes(raw=res_b)
-                ))
-            elif req_b[2:6] == b('00:02:8c:10'):
-                label = 'M1'
-                pairs.append(MessagePair(
-                    label=label,
-                    req=Message.build(io='in', label=label, raw=req_b),
-                    res=MessageResM1.from_bytes(raw=res_b),
-                ))
-            elif req_b[2] == 0x0 and 0x8 <= req_b[3] and req_b[3] <= 0xd:
-                label = 'BP'
-                mp = MessagePair(
-                    label='BP',
-                    req=Message.build(io='in', label=label, raw=req_b),
-                    res=MessageResBP.from_bytes(raw=res_b),
-                )
-                if pairs[-1].label != 'BP' or not merge_bp:
-                    pairs.append(mp)
-                else:
-                    # we combine all the BP measurements, and let the first req
-                    # (it will be "wrong' but we don't really care.
-                    assert isinstance(pairs[-1].res, MessageResBP)
-                    pairs[-1].res.merge(mp.res)
-            elif req_b[2:6] == b('c0:02:a4:10'):
-                label = 'M2'
-                assert req_b[2:-2] == res_b[2:-2]
-                pairs.append(MessagePair(
-                    label=label,
-                    req=MessageReqM2.from_bytes(raw=req_b),
-                    res=Message.build(io='out', label=label, raw=res_b),
-                ))
-            elif req_b[2:5] == b('c0:02:c2'):
-                label = 'M3'
-                assert req_b[2:-2] == res_b[2:-2]
-                pairs.append(MessagePair(
-                    label=label,
-                    req=MessageReqM3.from_bytes(raw=req_b),
-                    res=Message.build(io='out', label=label, raw=res_b),
-                ))
-            elif req_b[2:6] == b('00:00:00:00'):
-                label = 'M4'
+        for req_b, res_b in zip(frames[::2], frames[1::2]):
+            kind = kind_from_req(req_b)
+            if kind is None:
+                raise ValueError("Failed to match message " + pretty_hex(req_b[:6]))
+            if kind.echo:
                 assert req_b[2:-2] == res_b[2:-2]
-                pairs.append(MessagePair(
-                    label=label,
-                    req=Message.build(io='in', label=label, raw=req_b),
-                    res=Message.build(io='out', label=label, raw=res_b),
-                ))
+            mp = MessagePair(
+                label=kind.label,
+                req=kind.build_req(req_b),
+                res=kind.build_res(res_b),
+            )
+            if kind.label == 'BP' and merge_bp and pairs and pairs[-1].label == 'BP':
+                # we combine all the BP measurements, and let the first req
+                # (it will be "wrong' but we don't really care.
+                assert isinstance(pairs[-1].res, MessageResBP)
+                assert isinstance(mp.res, MessageResBP)
+                pairs[-1].res.merge(mp.res)
             else:
-                raise ValueError("Failed to match message " + pretty_hex(req_b[:6]))
+                pairs.append(mp)
         return cls(pairs=pairs)
 
 
 def res_builder_from_req(req: Message):
-    if req.label == 'M0':
-        return lambda raw: MessageResM0.from_bytes(raw=raw)
-    elif req.label == 'M1':
-        return lambda raw: MessageResM1.from_bytes(raw=raw)
-    elif req.label == 'BP':
-        return lambda raw: MessageResBP.from_bytes(raw=raw)
-    elif req.label == 'M2':
-        return lambda raw: Message.build(io='out', label='M2', raw=raw)
-    elif req.label == 'M3':
-        return lambda raw: Message.build(io='out', label='M3', raw=raw)
-    elif req.label == 'M4':
-        return lambda raw: Message.build(io='out', label='M4', raw=raw)
-
-
-if __name__ == '__main__':
+    kind = KINDS.get(req.label)
+    return kind.build_res if kind is not None else None
+
+
+def parse_args(args):
+    import argparse
+    parser = argparse.ArgumentParser("Split messages into labeled chunks")
+    parser.add_argument('files', nargs='+', help="FILE.json|FILE.frames (reassembled messages)")
+    parser.add_argument('--format', choices=('json', 'ndjson', 'frames'), default='json',
+                        help="json: chunked messages of one file; ndjson: a line per file "
+                             "with just the frames, chunks come from the message classes "
+                             "when read (see label_fmt.py); frames: binary, one file")
+    opts = parser.parse_args(args)
+    if opts.format != 'ndjson' and len(opts.files) > 1:
+        parser.error(f"--format {opts.format} takes a single file")
+    return opts
+
+def main(opts):
     import sys
     import json
+    import frames
     from pathlib import Path
-    if len(sys.argv) <= 1:
-        print("msg_parser.py FILE.json", file=sys.stderr)
-        sys.exit(1)
-
-    file = sys.argv[1]
-    hex_lines = json.loads(Path(file).read_bytes())
-    trans = Transaction.from_hex_list(hex_lines)
-    print(json.dumps(trans.to_json(), indent=2))
+    for file in opts.files:
+        fs = frames.load(file)
+        # parse anyway, so only valid transactions are written
+        trans = Transaction.from_frames(fs)
+        if opts.format == 'json':
+            print(json.dumps(trans.to_json(), indent=2))
+        elif opts.format == 'ndjson':
+            id = Path(file).name.rsplit('.', 1)[0].replace('.', ':')
+            sys.stdout.write(frames.dumps_line(id, fs))
+        else:
+            sys.stdout.buffer.write(frames.dumps(fs))
+
+if __name__ == '__main__':
+    import sys
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import checks
+import frames
+import human
+import msg_parser
+import tools
+from cache import Cache, source_version, digest, file_digest
+
+HUMAN_VERSION = source_version(human, tools, frames, checks)
+PARSER_VERSION = source_version(msg_parser, tools, frames)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser("Run the whole parse chain (dumps -> parsed -> parsed2) in one go")
+    parser.add_argument('-i', '--input', type=str, default='dumps_id',
+                        help="directory with json packet dumps")
+    parser.add_argument('--parsed', type=str, default='parsed',
+                        help="output dir for stage 0/1 (txt + hex json)")
+    parser.add_argument('--parsed2', type=str, default='parsed2',
+                        help="output dir for chunked messages")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument('--cache', type=str, default='.cache/pipeline',
+                        help="stage output cache dir")
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help="cache size limit in MB")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always recompute every stage")
+    parser.add_argument('--frames', action='store_true',
+                        help="write parsed/*.frames (binary) instead of parsed/*.json")
+    parser.add_argument('--compact', action='store_true',
+                        help="write parsed2/*.frames (just the frames, label_fmt.py chunks "
+                             "them when reading) instead of chunked json")
+    return parser.parse_args(args)
+
+def dump_json(obj) -> str:
+    # same as `print(json.dumps(obj, indent=2))` in the per-stage scripts
+    return json.dumps(obj, indent=2) + '\n'
+
+def run_raw(dump: Path) -> bytes:
+    with open(dump, 'r', encoding='utf-8') as fp:
+        return ''.join(line + '\n'
+                       for line in human.stage_raw(human.iter_packets(fp))).encode()
+
+def run_msgs(txt: bytes, fmt: str) -> bytes:
+    lines = txt.decode().split('\n')
+    return frames.dumps(checks.checked(human.iter_frames(lines)), fmt=fmt)
+
+def run_s2(msgs: bytes, compact: bool = False) -> bytes:
+    fs = frames.loads(msgs)
+    trans = msg_parser.Transaction.from_frames(fs)
+    if compact:
+        return frames.dumps(fs)
+    return dump_json(trans.to_json()).encode()
+
+def process(dump: Path, parsed: Path, parsed2: Path, cache: Cache | None = None,
+            fmt: str = 'json', compact: bool = False) -> int:
+    def stage(name, version, input_digest, build):
+        if cache is None:
+            return build()
+        return cache.cached(name, version, input_digest, build)
+
+    name = dump.name[:-5]
+    txt = stage('raw', HUMAN_VERSION, file_digest(dump), lambda: run_raw(dump))
+    (parsed / f'{name}.txt').write_bytes(txt)
+
+    msgs = stage(fmt, HUMAN_VERSION, digest(txt), lambda: run_msgs(txt, fmt))
+    (parsed / f'{name}.{fmt}').write_bytes(msgs)
+
+    s2 = 's2c' if compact else 's2'
+    chunked = stage(s2, PARSER_VERSION, digest(msgs), lambda: run_s2(msgs, compact))
+    ext, other = ('frames', 'json') if compact else ('json', 'frames')
+    (parsed2 / f'{name}.{ext}').write_bytes(chunked)
+    # label_fmt reads both, a leftover of the other format would show twice
+    (parsed2 / f'{name}.{other}').unlink(missing_ok=True)
+    return cache.hits if cache is not None else 0
+
+def _process(args) -> tuple[str, int, str | None]:
+    dump, parsed, parsed2, cache_dir, fmt, compact = args
+    cache = Cache(cache_dir) if cache_dir is not None else None
+    try:
+        hits = process(dump, parsed, parsed2, cache, fmt, compact)
+    except Exception:
+        return dump.name, 0, traceback.format_exc()
+    return dump.name, hits, None
+
+def main(opts):
+    parsed = Path(opts.parsed)
+    parsed2 = Path(opts.parsed2)
+    parsed.mkdir(parents=True, exist_ok=True)
+    parsed2.mkdir(parents=True, exist_ok=True)
+
+    cache_dir = None if opts.no_cache else opts.cache
+    fmt = 'frames' if opts.frames else 'json'
+    jobs = [(dump, parsed, parsed2, cache_dir, fmt, opts.compact)
+            for dump in sorted(Path(opts.input).glob('*.json'))]
+    failed = 0
+    with ProcessPoolExecutor(max_workers=opts.jobs) as pool:
+        for name, hits, err in pool.map(_process, jobs):
+            if err is None:
+                print(f"ok   {name} ({hits}/3 cached)", file=sys.stderr)
+            else:
+                failed += 1
+                print(f"FAIL {name}\n{err}", file=sys.stderr)
+    if cache_dir is not None:
+        Cache(cache_dir, max_bytes=opts.cache_size << 20).evict()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args(sys.argv[1:])))
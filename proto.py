@@ -1,28 +1,111 @@
 import msg_parser as msg
 from typing_extensions import Self
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
 from tools import to_bytes, pretty_hex
+from metrics import Metrics
 import datetime
+import json
+import os
+import time
 
 # NOTES:
 # - verify expected consts
 
-BP_ITEM_LEN = 0x0e
+BP_ITEM_LEN = msg.BP_ITEM_LEN
 BP_START_ADDR = 0x08 * 256 + 0x60
+# 0x0860 - 0x0dd8, 'last' is the 1-based slot of the newest record
+BP_RING_SZ = 100
+# response is 6 header + items + 2 cs bytes, length is a single byte
+BP_MAX_ITEMS = (0xff - 8) // BP_ITEM_LEN
+# a record that comes back broken in this many intact responses is broken
+# on the device, not in transit, and is skipped
+BP_MAX_BAD_READS = 3
+
+@dataclass
+class BPWindow:
+    # how many records to ask for per memory read
+    max_items: int = 4
+    # grow (x2) after intact reads, halve after a bad one; otherwise always
+    # read max_items
+    adaptive: bool = False
+    size: int = 4
+
+    def __post_init__(self):
+        assert 1 <= self.max_items <= BP_MAX_ITEMS
+        if not self.adaptive:
+            self.size = self.max_items
+        self.size = min(self.size, self.max_items)
+
+    def ok(self) -> None:
+        if self.adaptive:
+            self.size = min(self.size * 2, self.max_items)
+
+    def failed(self) -> None:
+        if self.adaptive:
+            self.size = max(self.size // 2, 1)
+
+@dataclass
+class Cursor:
+    # 'last'-style (1-based slot) id of the newest record read so far
+    read_id: int | None = None
+    # it as written by our last M3, M0 reports it back until somebody
+    # else's M3 (or a reset) changes it
+    it: int | None = None
+    synced_at: str | None = None
+
+class CursorStore:
+    # per device cursors, persisted as a single json file
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.cursors: dict[str, Cursor] = {}
+        if self.path.exists():
+            self.cursors = {dev_id: Cursor(**c)
+                            for dev_id, c in json.loads(self.path.read_bytes()).items()}
+
+    def get(self, dev_id: str) -> Cursor:
+        return self.cursors.setdefault(dev_id, Cursor())
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(json.dumps({dev_id: asdict(c) for dev_id, c in self.cursors.items()},
+                                  indent=2))
+        os.replace(tmp, self.path)
 
 @dataclass
 class Exchange:
     pairs: list[msg.MessagePair] = field(default_factory=list)
     req: msg.Message | None = None
+    bp_window: BPWindow = field(default_factory=BPWindow)
+    # when given, records up to cursor.read_id are not read again and the
+    # cursor is moved forward as records come in
+    cursor: Cursor | None = None
+    # pending records already read according to the cursor (set on M0)
+    bp_skip: int = 0
+    # ring slot -> responses (with a valid frame checksum) in which the
+    # record there was broken
+    bp_bad_reads: dict[int, int] = field(default_factory=dict)
+    # slots given up on after BP_MAX_BAD_READS, counted as fetched
+    bp_dropped: list[int] = field(default_factory=list)
+    # per message timings, nothing is measured when None
+    metrics: Metrics | None = None
+    # when the pending request was built
+    req_t0: float = 0.0
 
     def to_hex_list(self):
-        return [pretty_hex(msg.raw)
+        return [pretty_hex(raw) for raw in self.to_frames()]
+
+    def to_frames(self) -> list[bytes]:
+        return [bytes(msg.raw)
                 for pair in self.pairs
                 for msg in (pair.req, pair.res)]
 
     def get_req(self: Self) -> bytes | None:
         if self.req is None:
             self.req = self._build_next()
+            if self.metrics is not None:
+                self.req_t0 = time.perf_counter()
         return self.req.raw if self.req else None
 
     def set_res(self: Self, raw: bytes) -> None:
@@ -32,11 +115,46 @@ class Exchange:
         build_res = msg.res_builder_from_req(self.req)
         self.pairs.append(msg.MessagePair(req=self.req, res=build_res(raw),
                                              label=self.req.label))
-        if self.pairs[-1].label == 'BP':
-            assert isinstance(self.pairs[-1].res, msg.MessageResBP)
-            for bp_item in self.pairs[-1].res.items:
+        label = self.pairs[-1].label
+        records = 0
+        if label == 'M0':
+            self.bp_skip = self._bp_skip()
+        elif label == 'BP':
+            res = self.pairs[-1].res
+            assert isinstance(res, msg.MessageResBP)
+            intact = records = self._bp_intact(res)
+            slot = (self.req.raw[3] * 256 + self.req.raw[4] - BP_START_ADDR) // BP_ITEM_LEN
+            done = intact
+            if intact == self.req.raw[5] // BP_ITEM_LEN:
+                self.bp_window.ok()
+            else:
+                self.bp_window.failed()
+                bad = (slot + intact) % BP_RING_SZ
+                self.bp_bad_reads[bad] = self.bp_bad_reads.get(bad, 0) + 1
+                if self.bp_bad_reads[bad] >= BP_MAX_BAD_READS:
+                    print(f"-- skip bad record in slot {bad}")
+                    self.bp_dropped.append(bad)
+                    done += 1
+            for bp_item in res.items[:intact]:
                 print(f"bp -- {bp_item.to_human()}")
+            if self.cursor is not None and done:
+                self.cursor.read_id = (slot + done - 1) % BP_RING_SZ + 1
+        elif label == 'M3' and self.cursor is not None:
+            self.cursor.it = self.req.raw[0x0b]
+        elif label == 'M4' and self.cursor is not None:
+            self.cursor.synced_at = datetime.datetime.now().isoformat(timespec='seconds')
+
+        if self.metrics is not None:
+            self.metrics.record(label, self.req_t0, len(self.req.raw), len(raw), records)
+        self.req = None
 
+    def res_failed(self: Self) -> None:
+        # the response to the pending request never arrived intact, the
+        # request is rebuilt (possibly smaller) on the next get_req
+        if self.req is not None and self.req.label == 'BP':
+            self.bp_window.failed()
+        if self.req is not None and self.metrics is not None:
+            self.metrics.record(self.req.label, self.req_t0, len(self.req.raw), ok=False)
         self.req = None
 
     def _get(self, path) -> int:
@@ -58,7 +176,7 @@ class Exchange:
         elif last_req.label == 'M0':
             req = msg.Message.make_req(label='M1', payload=to_bytes('02:8c:10'))
         elif last_req.label == 'M1' or last_req.label == 'BP':
-            if self._total_bp_fetched() < self._get('M0.out.pend'):
+            if self.bp_skip + self._total_bp_fetched() < self._get('M0.out.pend'):
                 # fetch more
                 req = self._build_req_bp()
             else:
@@ -72,19 +190,47 @@ class Exchange:
 
         return req
 
+    @staticmethod
+    def _bp_intact(res: msg.MessageResBP) -> int:
+        # records are only counted up to the first broken one, the rest is
+        # read again (a record broken too often is dropped, see set_res)
+        return msg.bp_intact(item.raw for item in res.items)
+
     def _total_bp_fetched(self: Self) -> int:
-        total = 0
+        total = len(self.bp_dropped)
         for pair in self.pairs:
-            if pair.req.label == 'BP':
-                total += pair.req.raw[5] // BP_ITEM_LEN
+            if pair.label == 'BP':
+                assert isinstance(pair.res, msg.MessageResBP)
+                total += self._bp_intact(pair.res)
         return total
 
+    def _bp_skip(self: Self) -> int:
+        if self.cursor is None or self.cursor.read_id is None:
+            return 0
+        if self.cursor.it is not None and self.cursor.it != self._get('M0.out.it'):
+            # somebody else's M3 since ours, or the device got reset: the
+            # cursor says nothing about these records
+            return 0
+        pend = self._get('M0.out.pend')
+        last = self._get('M0.out.last')
+        unread_lb = last - pend
+        # how far into the unread records the cursor already is; anything
+        # outside of them means start over
+        done = (self.cursor.read_id - unread_lb) % BP_RING_SZ
+        if done == 0 and self.cursor.read_id == last:
+            # full ring (pend == BP_RING_SZ) and the newest record was read
+            done = pend
+        return done if done <= pend else 0
+
     def _build_req_bp(self: Self) -> msg.Message:
         # last is counted from 1, so it's actually upper-bound if 0-based
         unread_ub = self._get('M0.out.last')
-        unread_lb = unread_ub - self._get('M0.out.pend')
-        fetch_lb = unread_lb + self._total_bp_fetched()
-        fetch_ub = min(fetch_lb + 4, unread_ub)
+        pend = self._get('M0.out.pend')
+        fetched = self.bp_skip + self._total_bp_fetched()
+        # ring slot to read from, a read never crosses the end of the ring
+        fetch_lb = (unread_ub - pend + fetched) % BP_RING_SZ
+        fetch_ub = fetch_lb + min(self.bp_window.size, pend - fetched,
+                                  BP_RING_SZ - fetch_lb)
 
         print(f"-- fetch {fetch_lb} {fetch_ub}")
 
@@ -131,15 +277,11 @@ def compare(a, b, msg):
     print(f'{a == b}')
 
 
-def simulate(logfile: str):
+def simulate(logfile: str, fmt: str = 'json'):
     from pathlib import Path
-    import json
-
-    msgs = None
-    with open(logfile, 'r') as lf:
-        msgs = json.load(lf)
+    import frames
 
-    t = msg.Transaction.from_hex_list(msgs, merge_bp=False)
+    t = msg.Transaction.from_frames(frames.load(logfile), merge_bp=False)
 
     e = Exchange()
     idx = 0
@@ -156,13 +298,11 @@ def simulate(logfile: str):
 
     assert idx == len(t.pairs)
 
-    hex_list = e.to_hex_list()
-    fn = f'exchange_{datetime.datetime.now().isoformat()}.json'
-    Path(fn).write_text(
-        json.dumps(e.to_hex_list(), indent=2))
+    fn = f'exchange_{datetime.datetime.now().isoformat()}.{fmt}'
+    Path(fn).write_bytes(frames.dumps(e.to_frames(), fmt=fmt))
     print(f"log written to {fn}")
 
 
 if __name__ == '__main__':
     import sys
-    simulate(sys.argv[1])
+    simulate(sys.argv[1], *sys.argv[2:3])
@@ -0,0 +1,220 @@
+import asyncio
+import random
+import statistics
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+import msg_parser as msg
+from metrics import Metrics
+from proto import Exchange, CursorStore
+from transport import Transport, run_exchange, check_res
+
+# Syncs many cuffs from one event loop: at most `workers` sessions at a
+# time, devices with pending readings first, failing devices backed off
+# exponentially.
+
+@dataclass(kw_only=True)
+class DeviceState():
+    dev_id: str
+    connect: Callable[[], Transport]
+    # pending readings as last reported by the device's M0
+    pend: int = 0
+    # synced since pend was reported, readings may have been taken since;
+    # probed again before it is ranked for its next sync
+    pend_stale: bool = False
+    failures: int = 0
+    next_due: float = 0.0
+    synced: int = 0
+    latencies: list[float] = field(default_factory=list)
+    last_error: BaseException | None = None
+
+@dataclass(kw_only=True)
+class Scheduler():
+    workers: int = 4
+    # seconds between two syncs of the same device
+    interval: float = 0.0
+    backoff: float = 1.0
+    max_backoff: float = 300.0
+    max_failures: int = 5
+    exchange_factory: Callable[[], Exchange] = Exchange
+    # passed on to transport.run_exchange (timeout, retries)
+    run_kwargs: dict = field(default_factory=dict)
+    # resume interrupted syncs from persisted per-device cursors
+    cursors: CursorStore | None = None
+    # shared by all sessions, see metrics.py
+    metrics: Metrics | None = None
+    devices: dict[str, DeviceState] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    def add(self, dev_id: str, connect: Callable[[], Transport]) -> DeviceState:
+        dev = self.devices[dev_id] = DeviceState(dev_id=dev_id, connect=connect)
+        return dev
+
+    async def probe(self, dev: DeviceState) -> int:
+        # M0 alone is enough to learn how many readings are waiting
+        req = Exchange().get_req()
+        assert req is not None
+        res = await asyncio.wait_for(dev.connect().request(req),
+                                     self.run_kwargs.get('timeout', 5.0))
+        check_res(res)
+        dev.pend = msg.MessageResM0.from_bytes(raw=res)['pend'].to_i()
+        dev.pend_stale = False
+        return dev.pend
+
+    async def _probe(self, dev: DeviceState) -> None:
+        try:
+            await self.probe(dev)
+        except (asyncio.TimeoutError, ValueError, OSError) as exc:
+            dev.last_error = exc
+            # ranked by what is known, the sync deals with the error
+            dev.pend_stale = False
+
+    async def probe_all(self) -> None:
+        sem = asyncio.Semaphore(self.workers)
+
+        async def one(dev):
+            async with sem:
+                await self._probe(dev)
+
+        await asyncio.gather(*(one(dev) for dev in self.devices.values()))
+
+    def _pick(self, todo: set[str], now: float) -> DeviceState | None:
+        best: tuple | None = None
+        for dev_id in todo:
+            dev = self.devices[dev_id]
+            if dev.next_due > now:
+                continue
+            # stale ones first, they are only probed
+            key = (not dev.pend_stale, -dev.pend, dev.next_due, dev_id)
+            if best is None or key < best:
+                best = key
+        return self.devices[best[-1]] if best is not None else None
+
+    async def _sync(self, dev: DeviceState) -> bool:
+        t0 = time.perf_counter()
+        e = self.exchange_factory()
+        if self.cursors is not None:
+            e.cursor = self.cursors.get(dev.dev_id)
+        if self.metrics is not None:
+            e.metrics = self.metrics
+        error: BaseException | None = None
+        try:
+            await run_exchange(dev.connect(), e, **self.run_kwargs)
+        except (asyncio.TimeoutError, ValueError, AssertionError, OSError) as exc:
+            error = exc
+        finally:
+            # also when cancelled; a failed save doesn't hide how the sync
+            # went, it only counts as a failure of the device
+            if self.cursors is not None:
+                try:
+                    self.cursors.save()
+                except OSError as exc:
+                    print(f"{dev.dev_id}: saving cursors failed: {exc!r}", file=sys.stderr)
+                    error = error or exc
+        if error is not None:
+            dev.failures += 1
+            dev.last_error = error
+            delay = min(self.backoff * 2 ** (dev.failures - 1), self.max_backoff)
+            dev.next_due = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            return False
+        dev.latencies.append(time.perf_counter() - t0)
+        dev.failures = 0
+        dev.synced += 1
+        # everything reported by M0 was read
+        dev.pend = 0
+        dev.pend_stale = True
+        dev.next_due = time.monotonic() + self.interval
+        return True
+
+    async def run(self, rounds: int = 1) -> None:
+        # sync every device `rounds` times (devices failing max_failures
+        # times in a row are given up on)
+        target = {dev_id: dev.synced + rounds for dev_id, dev in self.devices.items()}
+        todo = set(self.devices)
+        busy: set[str] = set()
+        wake = asyncio.Event()
+
+        async def worker():
+            while True:
+                now = time.monotonic()
+                dev = self._pick(todo - busy, now)
+                if dev is None:
+                    if not todo:
+                        return
+                    idle = [self.devices[d].next_due for d in todo - busy]
+                    wake.clear()
+                    try:
+                        await asyncio.wait_for(wake.wait(),
+                                               max(min(idle) - now, 0.001) if idle else None)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                busy.add(dev.dev_id)
+                try:
+                    if dev.pend_stale:
+                        await self._probe(dev)
+                    else:
+                        await self._sync(dev)
+                finally:
+                    busy.discard(dev.dev_id)
+                if dev.synced >= target[dev.dev_id] or dev.failures >= self.max_failures:
+                    todo.discard(dev.dev_id)
+                wake.set()
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        self.elapsed += time.perf_counter() - t0
+
+    def report(self) -> str:
+        lines = []
+        sessions = sum(len(dev.latencies) for dev in self.devices.values())
+        rate = sessions / self.elapsed if self.elapsed else 0.0
+        lines.append(f"{sessions} sessions in {self.elapsed:.3f}s, {rate:.1f} sessions/s")
+        for dev in self.devices.values():
+            lat = dev.latencies
+            if lat:
+                lines.append(f"{dev.dev_id}: {len(lat)} ok, {dev.failures} failing, "
+                             f"latency mean {statistics.mean(lat) * 1000:.1f}ms "
+                             f"max {max(lat) * 1000:.1f}ms")
+            else:
+                lines.append(f"{dev.dev_id}: never synced, last error {dev.last_error!r}")
+        if self.metrics is not None:
+            lines.append(self.metrics.summary())
+        return '\n'.join(lines)
+
+if __name__ == '__main__':
+    import argparse
+    import contextlib
+    import io
+    from device_sim import Device
+    from transport import LoopbackTransport
+
+    parser = argparse.ArgumentParser("Sync a fleet of simulated devices")
+    parser.add_argument('-d', '--devices', type=int, default=20)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=1)
+    parser.add_argument('--delay', type=float, default=0.005,
+                        help="simulated link latency per message (s)")
+    parser.add_argument('--trace', type=str, help="write per message timings (json lines)")
+    opts = parser.parse_args(sys.argv[1:])
+
+    rng = random.Random(0)
+    sched = Scheduler(workers=opts.workers, metrics=Metrics(keep_events=bool(opts.trace)))
+    for i in range(opts.devices):
+        dev = Device()
+        dev.fill(rng.randint(0, 40), seed=i)
+        sched.add(f'cuff{i:0>3}', lambda dev=dev: LoopbackTransport(dev, delay=opts.delay))
+
+    async def main():
+        await sched.probe_all()
+        await sched.run(rounds=opts.rounds)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(main())
+    print(sched.report())
+    if opts.trace:
+        assert sched.metrics is not None
+        with open(opts.trace, 'w') as fp:
+            sched.metrics.write_jsonl(fp)
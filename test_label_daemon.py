@@ -0,0 +1,55 @@
+import json
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import human
+import label_fmt
+import lq
+
+REPO = Path(__file__).parent
+
+@pytest.fixture
+def daemon(tmp_path):
+    # label_daemon.py in its own directory, nothing preloaded
+    cwd = tmp_path / 'daemon'
+    cwd.mkdir()
+    sock = tmp_path / 'lq.sock'
+    proc = subprocess.Popen([sys.executable, REPO / 'label_daemon.py', '--socket', sock,
+                             '-i', cwd], cwd=cwd, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            if sock.exists():
+                break
+            time.sleep(0.05)
+        yield str(sock)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def test_query_paths_relative_to_client(tmp_path, monkeypatch, capsys, daemon):
+    client = tmp_path / 'client'
+    (client / 'p2').mkdir(parents=True)
+    shutil.copy(REPO / 'parsed2' / '00.json', client / 'p2')
+    (client / 'hx').mkdir()
+    # as `human.py --hex --index`
+    index: list[dict] = []
+    with open(REPO / 'dumps_id' / '00.json', encoding='utf-8') as fp:
+        for _ in human.stage_hex(human.stage_raw(human.iter_packets(fp)), index):
+            pass
+    (client / 'hx' / '00.idx.json').write_text(json.dumps({'row': human.HEX_ROW,
+                                                          'frames': index}))
+    monkeypatch.chdir(client)
+    args = ['-i', 'p2', '--hex-index', 'hx', '-f', 'msg=M0']
+    capsys.readouterr()
+    label_fmt.main(label_fmt.parse_args(args))
+    expected = capsys.readouterr().out
+    assert '@0000' in expected
+
+    res = lq.query(args, daemon)
+    assert res['status'] == 0, res['err']
+    assert res['out'] == expected
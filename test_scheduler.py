@@ -0,0 +1,38 @@
+import asyncio
+import contextlib
+import io
+
+from device_sim import Device
+from scheduler import Scheduler
+from transport import LoopbackTransport
+
+def test_rounds_rank_by_current_pend():
+    # one worker, so syncs happen strictly in ranking order
+    sched = Scheduler(workers=1)
+    devs = {}
+    for i, (dev_id, pend) in enumerate([('a', 5), ('b', 3), ('c', 1)]):
+        dev = devs[dev_id] = Device()
+        dev.fill(pend, seed=i)
+        sched.add(dev_id, lambda dev=dev: LoopbackTransport(dev))
+
+    order: list[str] = []
+    sync = sched._sync
+
+    async def recorded(dev):
+        order.append(dev.dev_id)
+        ok = await sync(dev)
+        if dev.dev_id == 'c' and dev.synced == 1:
+            # readings taken after its first sync
+            devs['c'].fill(10, seed=9)
+        return ok
+    sched._sync = recorded
+
+    async def main():
+        await sched.probe_all()
+        await sched.run(rounds=2)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(main())
+    assert order == ['a', 'b', 'c', 'c', 'a', 'b']
+    assert all(dev.synced == 2 for dev in sched.devices.values())
+    assert devs['c'].pend == 0
@@ -52,7 +52,7 @@ def safe_truncate(msg):
 def join(*pcs):
     return ':'.join(pcs)
 
-def pretty_hex(b): return ':'.join(f'{i:0>2x}' for i in b)
+def pretty_hex(b): return memoryview(bytes(b) if isinstance(b, list) else b).hex(':')
 
 def split_i(i: int, sb: int, l: int) -> int:
     s1 = i >> sb
@@ -0,0 +1,80 @@
+import asyncio
+from typing import Callable, Protocol
+
+from proto import Exchange
+from tools import verify_cs
+
+# Async driver for proto.Exchange. The Exchange stays a pure state machine
+# (get_req/set_res), a Transport moves one request/response over whatever
+# link there is (BLE, loopback, ...).
+
+class Transport(Protocol):
+    async def request(self, req: bytes) -> bytes: ...
+
+class ChecksumError(ValueError):
+    pass
+
+class LoopbackTransport():
+    # in-process "device": responder gets the request and returns the response
+    def __init__(self, responder: Callable[[bytes], bytes], delay: float = 0.0):
+        self.responder = responder
+        self.delay = delay
+        self.sent = 0
+
+    async def request(self, req: bytes) -> bytes:
+        self.sent += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.responder(req)
+
+def replay(frames: list[bytes]) -> Callable[[bytes], bytes]:
+    # answer the n-th request with the n-th recorded response (see
+    # proto.simulate), regardless of what was asked
+    responses = iter(frames[1::2])
+    return lambda req: next(responses)
+
+def check_res(raw: bytes) -> None:
+    if not raw or raw[0] != len(raw):
+        raise ChecksumError(f"bad length {raw[0] if raw else None} != {len(raw)}")
+    if not verify_cs(raw):
+        raise ChecksumError("bad checksum")
+
+async def run_exchange(transport: Transport, exchange: Exchange | None = None,
+                       timeout: float = 5.0, retries: int = 3) -> Exchange:
+    # Drive the exchange to completion. A response that times out or fails
+    # its checksum is requested again, up to `retries` extra times per
+    # message. Cancelling leaves the exchange with the current request still
+    # pending, so the same Exchange can be passed in again to resume.
+    if exchange is None:
+        exchange = Exchange()
+    while True:
+        req = exchange.get_req()
+        if req is None:
+            return exchange
+        for attempt in range(retries + 1):
+            try:
+                res = await asyncio.wait_for(transport.request(req), timeout)
+                check_res(res)
+            except (asyncio.TimeoutError, ChecksumError):
+                if attempt == retries:
+                    raise
+                exchange.res_failed()
+                req = exchange.get_req()
+                assert req is not None
+                continue
+            break
+        exchange.set_res(res)
+
+async def run_many(sessions: list[tuple[Transport, Exchange | None]], **kwargs) -> list[Exchange]:
+    return list(await asyncio.gather(*(run_exchange(t, e, **kwargs) for t, e in sessions)))
+
+if __name__ == '__main__':
+    import sys
+    import frames
+
+    if len(sys.argv) <= 1:
+        print("transport.py FILE.json|FILE.frames", file=sys.stderr)
+        sys.exit(1)
+
+    e = asyncio.run(run_exchange(LoopbackTransport(replay(frames.load(sys.argv[1])))))
+    print(f"exchange done, {len(e.pairs)} messages")